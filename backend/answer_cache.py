@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+from models import Conversation
+from conversation_memory import history_cache
+
+logger = logging.getLogger(__name__)
+
+# Answer cache configuration
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    """Answers keyed by (document, question embedding).
+
+    A lookup hits when a cached question about the same document has cosine
+    similarity of at least the threshold and has not outlived its TTL. The
+    cache holds at most max_entries answers, evicting least-recently-used.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # entry id -> entry
+        self._by_document = {}  # document -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, document, question_vector):
+        query = _normalize(question_vector)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_document.get(document, ())):
+                entry = self._entries[entry_id]
+                if now - entry["created_at"] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(entry["vector"], query))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            entry = self._entries[best_id]
+            return {"answer": entry["answer"], "sources": entry["sources"], "similarity": best_score}
+
+    def put(self, document, question_vector, answer, sources):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "document": document,
+                "vector": _normalize(question_vector),
+                "answer": answer,
+                "sources": sources,
+                "created_at": time.monotonic(),
+            }
+            self._by_document.setdefault(document, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, username):
+        """Drop this process's answers about a user's documents after their index changes.
+
+        Other workers stop serving theirs because the index version is part
+        of the document key.
+        """
+        with self._lock:
+            for document in [doc for doc in self._by_document if doc[0] == username]:
+                for entry_id in list(self._by_document.get(document, ())):
+                    self._remove(entry_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_document.get(entry["document"])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_document[entry["document"]]
+
+
+answer_cache = SemanticAnswerCache()
+
+
+def answer_cache_document(db, username, conversation_id):
+    """(username, file name) a question in this conversation is cached under, or None to bypass.
+
+    Follow-up questions are rewritten using the chat history, so only
+    questions asked before any history exists are cached.
+    """
+    entry = history_cache.get(db, conversation_id)
+    if entry["messages"] or entry["summary"]:
+        return None
+    conversation = db.get(Conversation, conversation_id)
+    if conversation is None:
+        return None
+    return (username, conversation.file_name)
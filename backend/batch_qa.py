@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+import logging
+from langchain_core.output_parsers import StrOutputParser
+from retrieval import search_by_vectors, merge_results
+from vector_store import get_embeddings
+from context_builder import CONTEXT_CANDIDATES, build_context
+from query_modes import QueryUsage
+from metrics import stage
+from llm_scheduler import LLM_DEADLINE_SECONDS, llm_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Batch question-answering configuration
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+
+
+def retrieve_batch(vector_stores, questions, k=CONTEXT_CANDIDATES):
+    """Token-budgeted context for every question, with one embedding request and one search per store"""
+    with stage("batch_query", "embed"):
+        vectors = get_embeddings().embed_queries(questions)
+    with stage("batch_query", "search"):
+        per_store = [search_by_vectors(store, vectors, [k] * len(questions)) for store in vector_stores]
+    with stage("batch_query", "build_context"):
+        return [
+            build_context(question, merge_results([results[i] for results in per_store], k))
+            for i, question in enumerate(questions)
+        ]
+
+
+async def answer_batch(llm, prompt, vector_stores, questions, user, concurrency=BATCH_LLM_CONCURRENCY):
+    """Answer independent questions about the same documents.
+
+    Retrieval for the whole batch runs up front; at most concurrency LLM
+    calls are then in flight, each also holding one of user's scheduler
+    slots. The batch was admitted as a whole, so its calls wait for slots
+    without the queue timeout. Yields (index, result) as answers finish, in
+    completion order. result has answer, source_documents and usage, or
+    error when that question failed. Stopping the iteration cancels the
+    calls still pending.
+    """
+    contexts = await asyncio.to_thread(retrieve_batch, vector_stores, questions)
+    chain = prompt | llm | StrOutputParser()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer(index, question, documents):
+        async with slots:
+            started = time.perf_counter()
+            usage = QueryUsage()
+            # Retrieval happened for the whole batch; count its context here
+            usage.on_retriever_end(documents)
+            try:
+                async with llm_scheduler.slot(user, bounded=False):
+                    async with asyncio.timeout(LLM_DEADLINE_SECONDS):
+                        with stage("batch_query", "llm"):
+                            text = await chain.ainvoke(
+                                {"context": "\n\n".join(doc.page_content for doc in documents), "question": question},
+                                config={"callbacks": [usage]},
+                            )
+            except TimeoutError:
+                logger.error(f"Batch question {index} missed its deadline")
+                return index, {"error": "The model did not answer in time"}
+            except Exception as e:
+                logger.error(f"Batch question {index} failed: {str(e)}")
+                return index, {"error": str(e)}
+            return index, {
+                "answer": text,
+                "source_documents": documents,
+                "usage": usage.report("batch", time.perf_counter() - started),
+            }
+
+    tasks = [
+        asyncio.ensure_future(answer(index, question, documents))
+        for index, (question, documents) in enumerate(zip(questions, contexts))
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
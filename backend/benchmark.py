@@ -0,0 +1,424 @@
+"""Offline ingest and query benchmark.
+
+Drives the real upload, ingestion, vector store and query code through the
+FastAPI app, with deterministic fake embeddings, a fake LLM, a local blob
+stand-in and SQLite in place of Azure, Groq and MySQL. Nothing leaves the
+machine. Example:
+
+    python benchmark.py --pages 10,100,500 --concurrency 1,4,16 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import itertools
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+VOCABULARY = [f"term{i}" for i in range(2000)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", default="10,100,500", help="corpus sizes in PDF pages")
+    parser.add_argument("--concurrency", default="1,4,16", help="concurrent query clients")
+    parser.add_argument("--queries", type=int, default=64, help="queries per concurrency level")
+    parser.add_argument("--modes", default="condense,single", help="query modes to measure")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--llm-latency-ms", type=float, default=50, help="simulated LLM call latency")
+    parser.add_argument("--embed-latency-ms", type=float, default=20, help="simulated embedding request latency")
+    parser.add_argument("--load-repeats", type=int, default=5)
+    parser.add_argument("--workdir", help="scratch directory (default: a new temporary directory)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    return parser.parse_args()
+
+
+def configure_environment(workdir):
+    """Point the application at local stand-ins; must run before app modules are imported"""
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+        "ASYNC_DATABASE_URL": f"sqlite+aiosqlite:///{workdir}/bench.db",
+        "EMBEDDING_BACKEND": "fake",
+        "EMBEDDING_CACHE_PATH": f"{workdir}/embedding_cache.sqlite",
+        "INGEST_SPOOL_DIR": f"{workdir}/spool",
+        "CONTAINER_NAME": "bench",
+        "SECRET_KEY": "benchmark",
+        "ALGORITHM": "HS256",
+        "ANSWER_CACHE_ENABLED": "false",
+    })
+    os.environ.setdefault("GROQ_API_KEY", "benchmark")
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+
+
+def page_text(tag, number, words):
+    rng = random.Random(f"{tag}-{number}")
+    return f"{tag} page {number} " + " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def make_pdf(path, pages):
+    """Minimal text-only PDF with one line of text per page"""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages))), len(pages)
+        ),
+    ]
+    font_id = 3 + 2 * len(pages)
+    for i, text in enumerate(pages):
+        stream = f"BT /F1 8 Tf 20 760 Td ({text}) Tj ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    out = "%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, "w", encoding="latin-1") as f:
+        f.write(out)
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "p50_ms": round(cuts[49] * 1000, 2),
+        "p95_ms": round(cuts[94] * 1000, 2),
+        "p99_ms": round(cuts[98] * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def install_stand_ins(args):
+    """Swap the LLMs, embeddings and blob client for local fakes"""
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    import clients
+    import vector_store
+    import embedding_cache
+    from routes import trial
+
+    class LocalBlobClient:
+        def __init__(self, root, name):
+            self.path = os.path.join(root, name)
+            self.staged = {}
+
+        async def stage_block(self, block_id, data, **kwargs):
+            self.staged[block_id] = data
+
+        async def commit_block_list(self, blocks, **kwargs):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as f:
+                for block in blocks:
+                    f.write(self.staged.pop(block.id))
+
+        async def delete_blob(self, **kwargs):
+            os.remove(self.path)
+
+    class LocalBlobService:
+        def __init__(self, root):
+            self.root = root
+
+        def get_blob_client(self, container, blob):
+            return LocalBlobClient(os.path.join(self.root, container), blob)
+
+        async def close(self):
+            pass
+
+    class LatencyFakeEmbeddings(embedding_cache.FakeEmbeddings):
+        def embed_documents(self, texts):
+            time.sleep(args.embed_latency_ms / 1000)
+            return super().embed_documents(texts)
+
+    class LatencyFakeChatModel(GenericFakeChatModel):
+        latency: float = 0.0
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            return self._generate(messages, stop=stop, **kwargs)
+
+    def fake_llm(tags=None):
+        answers = itertools.cycle(["The document covers several of the requested terms in detail."])
+        return LatencyFakeChatModel(messages=answers, latency=args.llm_latency_ms / 1000, tags=tags)
+
+    clients._blob_service_client = LocalBlobService(os.path.join(os.getcwd(), "blobs"))
+    vector_store.FakeEmbeddings = LatencyFakeEmbeddings
+    trial.llm = fake_llm()
+    trial.answer_llm = fake_llm(["answer"])
+
+
+def create_user(username):
+    from database import SessionLocal
+    from models import User
+    from routes.auth import create_access_token
+    from datetime import timedelta
+
+    with SessionLocal() as db:
+        user = User(username=username, email=f"{username}@bench.local", hashed_password="unused")
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        token = create_access_token(user, timedelta(hours=2))
+    return {"Authorization": f"Bearer {token}"}
+
+
+def create_conversation(username, file_name):
+    from database import SessionLocal
+    from models import User
+    from routes.utils import add_conversations
+
+    with SessionLocal() as db:
+        user = db.query(User).filter(User.username == username).first()
+        return add_conversations(db, user.id, file_name, f"bench_{file_name}")
+
+
+async def bench_upload(client, headers, pdf_path, pages):
+    """End-to-end ingest through /rag/upload until the job reports done"""
+    with open(pdf_path, "rb") as f:
+        data = f.read()
+    started = time.perf_counter()
+    response = await client.post(
+        "/rag/upload", headers=headers, files={"file": (os.path.basename(pdf_path), data, "application/pdf")}
+    )
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        status = (await client.get(f"/rag/upload/{job_id}", headers=headers)).json()
+        if status["status"] in ("done", "failed"):
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    if status["status"] != "done":
+        raise RuntimeError(f"Ingestion failed: {status['error']}")
+    return {
+        "path": "upload",
+        "pages": pages,
+        "chunks": status["chunks_total"],
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(pages / elapsed, 1),
+        "chunks_per_s": round(status["chunks_total"] / elapsed, 1),
+    }
+
+
+def bench_create_vector_db(username, pdf_path, pages):
+    """create_vector_db on already parsed pages: chunking, embedding and indexing only"""
+    from langchain_community.document_loaders import PyPDFLoader
+    from vector_store import create_vector_db
+
+    documents = list(PyPDFLoader(pdf_path).lazy_load())
+    counts = {}
+    started = time.perf_counter()
+    create_vector_db(documents, username, on_progress=counts.update, file_name=os.path.basename(pdf_path))
+    elapsed = time.perf_counter() - started
+    return {
+        "path": "create_vector_db",
+        "pages": pages,
+        "chunks": counts.get("chunks_total", 0),
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(pages / elapsed, 1),
+        "chunks_per_s": round(counts.get("chunks_total", 0) / elapsed, 1),
+    }
+
+
+def bench_index_load(username, file_name, pages, repeats):
+    from vector_cache import vector_cache
+    from vector_store import load_document_store
+
+    cold = []
+    for _ in range(repeats):
+        vector_cache.invalidate_user(username)
+        started = time.perf_counter()
+        vector_store = load_document_store(username, file_name)
+        cold.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    load_document_store(username, file_name)
+    warm = time.perf_counter() - started
+    return {
+        "pages": pages,
+        "vectors": vector_store.index.ntotal,
+        "cold_load_ms": round(statistics.median(cold) * 1000, 2),
+        "warm_load_ms": round(warm * 1000, 3),
+    }
+
+
+def bench_chain_build(username, file_name, conversation_id, repeats):
+    from database import SessionLocal
+    from vector_store import load_document_stores
+    from routes.trial import create_conversation_chain
+
+    vector_stores = load_document_stores(username, [file_name])
+    timings = []
+    with SessionLocal() as db:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            create_conversation_chain(vector_stores, conversation_id, db)
+            timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 2)
+
+
+async def bench_queries(client, headers, username, file_name, pages, concurrency, total, mode):
+    """total /rag/query calls spread over concurrency clients, one conversation each"""
+    conversations = await asyncio.to_thread(
+        lambda: [create_conversation(username, file_name) for _ in range(concurrency)]
+    )
+    rng = random.Random(f"{pages}-{concurrency}-{mode}")
+    questions = [
+        f"What does page {rng.randrange(pages)} say about {rng.choice(VOCABULARY)}?" for _ in range(total)
+    ]
+    latencies, errors, first_error = [], 0, None
+
+    async def worker(conversation_id, share):
+        nonlocal errors, first_error
+        for question in share:
+            started = time.perf_counter()
+            response = await client.post(
+                "/rag/query",
+                headers=headers,
+                json={"question": question, "conversation_id": conversation_id, "mode": mode},
+            )
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+                first_error = first_error or f"{response.status_code} {response.text[:200]}"
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        worker(conversation_id, questions[i::concurrency]) for i, conversation_id in enumerate(conversations)
+    ))
+    elapsed = time.perf_counter() - started
+    return dict(
+        {"pages": pages, "mode": mode, "concurrency": concurrency, "errors": errors,
+         "first_error": first_error, "throughput_qps": round(len(latencies) / elapsed, 2)},
+        **(summarize(latencies) if latencies else {"count": 0}),
+    )
+
+
+async def run(args):
+    import httpx
+    import main
+    from database import async_engine
+
+    install_stand_ins(args)
+    page_counts = [int(value) for value in args.pages.split(",")]
+    concurrency_levels = [int(value) for value in args.concurrency.split(",")]
+    modes = args.modes.split(",")
+    results = {"ingest": [], "index_load": [], "chain_build": [], "query": []}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for pages in page_counts:
+                username = f"bench{pages}"
+                file_name = f"corpus_{pages}.pdf"
+                headers = await asyncio.to_thread(create_user, username)
+                pdf_path = os.path.join(os.getcwd(), file_name)
+                make_pdf(pdf_path, [page_text("upload", i, args.words_per_page) for i in range(pages)])
+                print(f"[{pages} pages] ingest via /rag/upload", flush=True)
+                results["ingest"].append(await bench_upload(client, headers, pdf_path, pages))
+
+                # Distinct text so the embedding cache does not serve these chunks
+                direct_path = os.path.join(os.getcwd(), f"direct_{pages}.pdf")
+                make_pdf(direct_path, [page_text("direct", i, args.words_per_page) for i in range(pages)])
+                print(f"[{pages} pages] ingest via create_vector_db", flush=True)
+                results["ingest"].append(
+                    await asyncio.to_thread(bench_create_vector_db, f"direct{pages}", direct_path, pages)
+                )
+
+                results["index_load"].append(
+                    await asyncio.to_thread(bench_index_load, username, file_name, pages, args.load_repeats)
+                )
+                conversation_id = await asyncio.to_thread(create_conversation, username, file_name)
+                results["chain_build"].append({
+                    "pages": pages,
+                    "median_ms": await asyncio.to_thread(bench_chain_build, username, file_name, conversation_id, 20),
+                })
+
+                for mode in modes:
+                    for concurrency in concurrency_levels:
+                        print(f"[{pages} pages] {args.queries} queries, mode={mode}, concurrency={concurrency}", flush=True)
+                        results["query"].append(await bench_queries(
+                            client, headers, username, file_name, pages, concurrency, args.queries, mode
+                        ))
+    await async_engine.dispose()
+    return results
+
+
+def print_report(results):
+    print("\nIngest")
+    for row in results["ingest"]:
+        print(f"  {row['path']:<17} {row['pages']:>6} pages {row['chunks']:>7} chunks "
+              f"{row['seconds']:>8.2f}s {row['pages_per_s']:>8.1f} pages/s {row['chunks_per_s']:>8.1f} chunks/s")
+    print("Index load")
+    for row in results["index_load"]:
+        print(f"  {row['pages']:>6} pages {row['vectors']:>7} vectors "
+              f"cold {row['cold_load_ms']:>8.2f}ms warm {row['warm_load_ms']:>7.3f}ms")
+    print("Query")
+    for row in results["query"]:
+        print(f"  {row['pages']:>6} pages {row['mode']:<9} c={row['concurrency']:<3} "
+              f"p50 {row.get('p50_ms', 0):>8.1f}ms p95 {row.get('p95_ms', 0):>8.1f}ms "
+              f"p99 {row.get('p99_ms', 0):>8.1f}ms {row['throughput_qps']:>7.1f} q/s errors {row['errors']}")
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="retriver-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(workdir)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    results = asyncio.run(run(args))
+    report = {
+        "meta": {
+            "started_at": started_at,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workdir": workdir,
+            "parameters": vars(args),
+        },
+        **results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(results)
+    print(f"\nResults written to {output}")
+
+    # A run whose queries failed measures nothing; don't let it pass as a result
+    failed = [row for row in results["query"] if row["errors"] or not row["count"]]
+    if failed:
+        for row in failed:
+            print(f"ERROR: {row['pages']} pages {row['mode']} c={row['concurrency']}: "
+                  f"{row['errors']} failed queries, first: {row['first_error']}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from database import SessionLocal
+from models import message
+
+logger = logging.getLogger(__name__)
+
+# Write-behind configuration
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() == "true"
+CHAT_FLUSH_INTERVAL_MS = float(os.getenv("CHAT_FLUSH_INTERVAL_MS", "50"))
+CHAT_FLUSH_MAX_TURNS = int(os.getenv("CHAT_FLUSH_MAX_TURNS", "200"))
+CHAT_QUEUE_MAX_TURNS = int(os.getenv("CHAT_QUEUE_MAX_TURNS", "10000"))
+CHAT_FLUSH_RETRIES = int(os.getenv("CHAT_FLUSH_RETRIES", "3"))
+# Turns the database keeps refusing are appended here and written later
+CHAT_SPILL_PATH = os.getenv("CHAT_SPILL_PATH", "chat_spill.jsonl")
+
+_STOP = object()
+
+
+def write_messages(db, turns):
+    """Insert the messages of (conversation_id, created_at, [(sender, content)]) turns in one transaction"""
+    db.add_all([
+        message(conversation_id=conversation_id, content=content, sender=sender, created_at=created_at)
+        for conversation_id, created_at, rows in turns
+        for sender, content in rows
+    ])
+    db.commit()
+
+
+class ChatWriter:
+    """Write-behind queue for chat messages.
+
+    Turns from any number of conversations are queued and inserted by one
+    background thread, CHAT_FLUSH_MAX_TURNS at a time in a single
+    transaction, at most CHAT_FLUSH_INTERVAL_MS after they were queued.
+    A turn is acknowledged before it is committed, so a crash can lose
+    the turns of the last flush interval; a clean shutdown drains the
+    queue first. A failed batch is retried, then written turn by turn so
+    one bad turn does not take the rest with it. Turns that still fail are
+    spilled to CHAT_SPILL_PATH and replayed when the writer starts and
+    after the next batch that goes through. When the queue is full, submit
+    blocks until the writer catches up.
+    """
+
+    def __init__(self, interval_ms=CHAT_FLUSH_INTERVAL_MS, max_turns=CHAT_FLUSH_MAX_TURNS,
+                 max_queued=CHAT_QUEUE_MAX_TURNS, retries=CHAT_FLUSH_RETRIES):
+        self.interval = interval_ms / 1000
+        self.max_turns = max_turns
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._pending = Counter()
+        self._flushed = threading.Condition()
+        self._thread = None
+        self.batches = 0
+        self.turns = 0
+        self.spilled_turns = 0
+        self._spilled = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, conversation_id, rows):
+        """Queue [(sender, content)] messages of one turn; written synchronously when not running"""
+        turn = (conversation_id, datetime.now(timezone.utc), rows)
+        if not self.running:
+            with SessionLocal() as db:
+                write_messages(db, [turn])
+            return
+        with self._flushed:
+            self._pending[conversation_id] += 1
+        self._queue.put(turn)
+
+    def wait_for(self, conversation_id, timeout=None):
+        """Block until the queued turns of a conversation are written"""
+        with self._flushed:
+            return self._flushed.wait_for(lambda: not self._pending[conversation_id], timeout)
+
+    def close(self, timeout=30):
+        """Write everything queued, then stop the writer thread"""
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Chat writer did not drain within {timeout}s; {self._queue.qsize()} turns unwritten")
+
+    def _run(self):
+        self._replay_spilled()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_turns:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            if stopping:
+                batch.extend(self._drain())
+            for start in range(0, len(batch), self.max_turns):
+                self._write(batch[start:start + self.max_turns])
+
+    def _drain(self):
+        turns = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return turns
+            if item is not _STOP:
+                turns.append(item)
+
+    def _write(self, batch):
+        try:
+            if self._store(batch, self.retries) and self._spilled:
+                # The database is taking writes again
+                self._replay_spilled()
+        finally:
+            with self._flushed:
+                self._pending.subtract(turn[0] for turn in batch)
+                for conversation_id, _, _ in batch:
+                    if self._pending[conversation_id] <= 0:
+                        self._pending.pop(conversation_id, None)
+                self._flushed.notify_all()
+
+    def _store(self, batch, retries):
+        """Write a batch, falling back to one turn at a time; returns False if any turn was spilled"""
+        for attempt in range(retries):
+            try:
+                with SessionLocal() as db:
+                    write_messages(db, batch)
+                self.batches += 1
+                self.turns += len(batch)
+                return True
+            except Exception as e:
+                logger.warning(f"Chat write of {len(batch)} turns failed (attempt {attempt + 1}): {str(e)}")
+                time.sleep(min(2 ** attempt * 0.1, 2))
+        failed = []
+        for turn in batch:
+            try:
+                with SessionLocal() as db:
+                    write_messages(db, [turn])
+                self.turns += 1
+            except Exception as e:
+                logger.error(f"Chat turn for conversation {turn[0]} failed, spilling it: {str(e)}")
+                failed.append(turn)
+        self._spill(failed)
+        return not failed
+
+    def _spill(self, turns):
+        if not turns:
+            return
+        lines = "".join(
+            json.dumps([conversation_id, created_at.isoformat(), rows]) + "\n"
+            for conversation_id, created_at, rows in turns
+        )
+        try:
+            # One append per batch, so workers sharing the file don't interleave lines
+            with open(CHAT_SPILL_PATH, "a") as f:
+                f.write(lines)
+        except OSError as e:
+            logger.error(f"Dropping {len(turns)} chat turns, spill file unwritable: {str(e)}")
+            return
+        self.spilled_turns += len(turns)
+        self._spilled = True
+
+    def _replay_spilled(self):
+        """Write turns spilled by any worker; ones that fail again stay spilled"""
+        self._spilled = False
+        # Claim the file so two workers never replay the same turns
+        claimed = f"{CHAT_SPILL_PATH}.{os.getpid()}"
+        try:
+            os.replace(CHAT_SPILL_PATH, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed) as f:
+            turns = [
+                (conversation_id, datetime.fromisoformat(created_at), [tuple(row) for row in rows])
+                for conversation_id, created_at, rows in map(json.loads, filter(str.strip, f))
+            ]
+        logger.info(f"Replaying {len(turns)} spilled chat turns")
+        for start in range(0, len(turns), self.max_turns):
+            self._store(turns[start:start + self.max_turns], 1)
+        # Turns that failed again were spilled anew; don't retry them until
+        # a fresh batch goes through
+        self._spilled = False
+        os.remove(claimed)
+
+    def stats(self):
+        return {
+            "enabled": self.running,
+            "queued_turns": self._queue.qsize(),
+            "batches": self.batches,
+            "turns_written": self.turns,
+            "turns_spilled": self.spilled_turns,
+            "avg_turns_per_batch": self.turns / self.batches if self.batches else 0.0,
+        }
+
+
+chat_writer = ChatWriter()
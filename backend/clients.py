@@ -0,0 +1,92 @@
+import os
+import logging
+import aiohttp
+import httpx
+from dotenv import load_dotenv
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Azure configuration
+AZURE_CONNECTION_STRING = os.getenv("AZURE_CONNECTION_STRING")
+CONTAINER_NAME = os.getenv("CONTAINER_NAME")
+
+# Outbound HTTP pool configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+
+_blob_service_client = None
+_http_client = None
+_http_async_client = None
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_http_client():
+    """Pooled keep-alive HTTP client for synchronous SDK calls"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(limits=_http_limits(), timeout=HTTP_TIMEOUT)
+    return _http_client
+
+
+def get_http_async_client():
+    """Pooled keep-alive HTTP client for asynchronous SDK calls"""
+    global _http_async_client
+    if _http_async_client is None:
+        _http_async_client = httpx.AsyncClient(limits=_http_limits(), timeout=HTTP_TIMEOUT)
+    return _http_async_client
+
+
+def get_blob_service_client():
+    """Application-scoped blob client; its connections are reused across requests"""
+    global _blob_service_client
+    if _blob_service_client is None:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, keepalive_timeout=HTTP_KEEPALIVE_EXPIRY)
+        transport = AioHttpTransport(session=aiohttp.ClientSession(connector=connector), session_owner=True)
+        _blob_service_client = BlobServiceClient.from_connection_string(
+            AZURE_CONNECTION_STRING,
+            transport=transport,
+            connection_timeout=HTTP_TIMEOUT,
+            read_timeout=HTTP_TIMEOUT,
+        )
+    return _blob_service_client
+
+
+async def open_clients():
+    get_blob_service_client()
+    get_http_client()
+    get_http_async_client()
+    logger.info("Shared clients created")
+
+
+async def close_clients():
+    global _blob_service_client, _http_client, _http_async_client
+    if _blob_service_client is not None:
+        await _blob_service_client.close()
+        _blob_service_client = None
+    if _http_async_client is not None:
+        await _http_async_client.aclose()
+        _http_async_client = None
+    if _http_client is not None:
+        _http_client.close()
+        _http_client = None
+
+
+def pool_stats(pool):
+    """Checked-in/out counts for a SQLAlchemy connection pool"""
+    stats = {"status": pool.status()}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
@@ -0,0 +1,140 @@
+import os
+import asyncio
+import logging
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from retrieval import query_batcher, search_stores
+from vector_store import get_embeddings
+from conversation_memory import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Context configuration
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MMR = os.getenv("CONTEXT_MMR", "false").lower() == "true"
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.5"))
+# Shortest shared text taken as chunk overlap when chunks carry no offsets
+MIN_OVERLAP_CHARS = 20
+
+
+def _join(first, second):
+    """second's text appended to first's without what they share, or None if they do not touch"""
+    first_start = first.metadata.get("start_index")
+    second_start = second.metadata.get("start_index")
+    if first_start is not None and second_start is not None:
+        shared = first_start + len(first.page_content) - second_start
+        if shared < 0 or second_start < first_start:
+            return None
+        return first.page_content + second.page_content[shared:]
+    # Chunks indexed before offsets were stored: look for the overlap itself
+    for size in range(min(len(first.page_content), len(second.page_content)), MIN_OVERLAP_CHARS - 1, -1):
+        if second.page_content.startswith(first.page_content[-size:]):
+            return first.page_content + second.page_content[size:]
+    return None
+
+
+def merge_chunks(ranked):
+    """Merge overlapping and adjacent chunks of the same page.
+
+    Groups keep the rank of their best chunk and are returned best first.
+    """
+    groups = []  # [rank, document, merged chunk count]
+    for rank, doc in sorted(
+        enumerate(ranked),
+        key=lambda item: (
+            str(item[1].metadata.get("file_name")), str(item[1].metadata.get("page")),
+            item[1].metadata.get("start_index", 0),
+        ),
+    ):
+        last = groups[-1] if groups else None
+        same_page = last is not None and all(
+            last[1].metadata.get(key) == doc.metadata.get(key) for key in ("file_name", "source", "page")
+        )
+        text = None
+        if same_page:
+            text = _join(last[1], doc)
+            if text is None and doc.metadata.get("start_index") is None:
+                text = _join(doc, last[1])
+        if text is None:
+            groups.append([rank, doc, 1])
+            continue
+        metadata = dict(last[1].metadata)
+        if "start_index" in metadata:
+            metadata["start_index"] = min(metadata["start_index"], doc.metadata.get("start_index", 0))
+        last[0] = min(last[0], rank)
+        last[1] = Document(page_content=text, metadata=metadata)
+        last[2] += 1
+    groups.sort(key=lambda group: group[0])
+    return [
+        Document(page_content=doc.page_content, metadata=dict(doc.metadata, merged_chunks=count))
+        for _, doc, count in groups
+    ]
+
+
+def build_context(query, candidates, token_budget=CONTEXT_TOKEN_BUDGET, mmr=CONTEXT_MMR,
+                  lambda_mult=CONTEXT_MMR_LAMBDA):
+    """Choose and merge retrieved chunks to fill token_budget.
+
+    Candidates arrive nearest first. Exact duplicates are dropped; with mmr
+    they are re-ranked for diversity. Chunks are then taken in rank order
+    while the merged context still fits, so overlapping text is only paid
+    for once. Each returned document records its token count in
+    metadata["tokens"].
+    """
+    unique = {}
+    for doc in candidates:
+        unique.setdefault(doc.page_content, doc)
+    ranked = list(unique.values())
+    if mmr and len(ranked) > 1:
+        embeddings = get_embeddings()
+        # Both come from the embedding caches filled at ingest and retrieval
+        query_vector = np.asarray(embeddings.embed_query(query))
+        vectors = embeddings.embed_documents([doc.page_content for doc in ranked])
+        order = maximal_marginal_relevance(query_vector, vectors, lambda_mult=lambda_mult, k=len(ranked))
+        ranked = [ranked[i] for i in order]
+
+    token_counts = {}
+
+    def tokens(doc):
+        if doc.page_content not in token_counts:
+            token_counts[doc.page_content] = count_tokens(doc.page_content)
+        return token_counts[doc.page_content]
+
+    selected, context = [], []
+    for doc in ranked:
+        merged = merge_chunks(selected + [doc])
+        if sum(tokens(chunk) for chunk in merged) <= token_budget:
+            selected.append(doc)
+            context = merged
+    if not context and ranked:
+        # Even the best chunk is over budget; send as much of it as fits
+        best = ranked[0]
+        context = [Document(
+            page_content=truncate_tokens(best.page_content, token_budget),
+            metadata=dict(best.metadata, merged_chunks=1),
+        )]
+    for doc in context:
+        doc.metadata["tokens"] = tokens(doc)
+    return context
+
+
+class ContextRetriever(BaseRetriever):
+    """Retrieves candidates from the document shards and assembles a token-budgeted context"""
+
+    vector_stores: List[Any]
+    candidates: int = CONTEXT_CANDIDATES
+    token_budget: int = CONTEXT_TOKEN_BUDGET
+    mmr: bool = CONTEXT_MMR
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        vector = get_embeddings().embed_query(query)
+        candidates = search_stores(self.vector_stores, vector, self.candidates)
+        return build_context(query, candidates, self.token_budget, self.mmr)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        candidates = await query_batcher.search(self.vector_stores, query, self.candidates)
+        return await asyncio.to_thread(build_context, query, candidates, self.token_budget, self.mmr)
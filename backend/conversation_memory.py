@@ -0,0 +1,191 @@
+import os
+import asyncio
+import threading
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+import tiktoken
+from sqlalchemy import func
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.messages import SystemMessage
+from models import message
+from chat_writer import chat_writer
+
+logger = logging.getLogger(__name__)
+
+# History configuration
+HISTORY_MODE = os.getenv("HISTORY_MODE", "full")  # full | window | summary
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "10"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "1024"))
+
+
+# Rough size of a token in English text, for when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """The tokenizer, or None when it cannot be loaded.
+
+    tiktoken downloads the encoding on first use; offline, without a
+    cached copy, token counts fall back to a character estimate.
+    """
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Could not load the tiktoken encoding, estimating tokens from characters: {str(e)}")
+        return None
+
+
+def count_tokens(text):
+    encoding = _encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """The longest prefix of text that fits in max_tokens"""
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def _format_lines(messages):
+    return "\n".join(
+        f"{'Human' if sender == 'user' else 'AI'}: {content}" for sender, content in messages
+    )
+
+
+class ConversationHistoryCache:
+    """Per-conversation chat history kept in memory.
+
+    A conversation is read from the database once, after which new turns are
+    appended as add_turn writes them. In summary mode the oldest turns are
+    folded into a rolling summary so the kept history fits the token budget.
+
+    Other workers append turns this process never sees, so each use checks
+    the conversation's message count in the table against the entry and
+    reloads it when they differ.
+    """
+
+    def __init__(self, max_conversations=HISTORY_CACHE_SIZE):
+        self.max_conversations = max_conversations
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, db, conversation_id):
+        # Turns still in the write-behind queue would be missing from the table
+        chat_writer.wait_for(conversation_id)
+        rows = (
+            db.query(message)
+            .filter(message.conversation_id == conversation_id)
+            .order_by(message.id)
+            .all()
+        )
+        return {"messages": [(row.sender, row.content) for row in rows], "summary": "", "count": len(rows)}
+
+    def _stored_count(self, db, conversation_id):
+        chat_writer.wait_for(conversation_id)
+        return (
+            db.query(func.count(message.id))
+            .filter(message.conversation_id == conversation_id)
+            .scalar()
+        )
+
+    def get(self, db, conversation_id):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+        if entry is not None:
+            if self._stored_count(db, conversation_id) == entry["count"]:
+                with self._lock:
+                    if conversation_id in self._entries:
+                        self._entries.move_to_end(conversation_id)
+                return entry
+            # Turns were added elsewhere (or a local append raced a load)
+            with self._lock:
+                if self._entries.get(conversation_id) is entry:
+                    del self._entries[conversation_id]
+        entry = self._load(db, conversation_id)
+        with self._lock:
+            # Another request may have loaded it meanwhile; keep the first copy
+            entry = self._entries.setdefault(conversation_id, entry)
+            self._entries.move_to_end(conversation_id)
+            while len(self._entries) > self.max_conversations:
+                self._entries.popitem(last=False)
+        return entry
+
+    def append(self, conversation_id, sender, content):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                entry["messages"].append((sender, content))
+                entry["count"] += 1
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    async def summarize_overflow(self, entry, llm, token_budget, config=None):
+        """Fold the oldest turns into the rolling summary until the rest fit"""
+        with self._lock:
+            messages = entry["messages"]
+            folded = 0
+            while len(messages) - folded > 2 and count_tokens(_format_lines(messages[folded:])) > token_budget:
+                folded += 2
+            overflow = messages[:folded]
+            summary = entry["summary"]
+        if not overflow:
+            return
+        prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=_format_lines(overflow))
+        # Turns stay in the history until their summary exists
+        new_summary = (await llm.ainvoke(prompt, config=config)).content
+        with self._lock:
+            # Another request may have folded these turns in meanwhile
+            if entry["summary"] == summary and entry["messages"][:folded] == overflow:
+                del entry["messages"][:folded]
+                entry["summary"] = new_summary
+
+
+history_cache = ConversationHistoryCache()
+
+
+async def summarize_history(db, conversation_id, llm, config=None, mode=HISTORY_MODE):
+    """In summary mode, fold overflowing turns into the summary before build_memory reads them.
+
+    This is an LLM call: callers run it under the LLM scheduler.
+    """
+    if mode != "summary":
+        return
+    entry = await asyncio.to_thread(history_cache.get, db, conversation_id)
+    await history_cache.summarize_overflow(entry, llm, HISTORY_TOKEN_BUDGET, config)
+
+
+def build_memory(db, conversation_id, llm, mode=HISTORY_MODE):
+    """Build chain memory for a conversation from the cached history.
+
+    In summary mode, call summarize_history first so the kept turns fit
+    the token budget.
+    """
+    entry = history_cache.get(db, conversation_id)
+    messages = list(entry["messages"])
+    if mode == "window":
+        messages = messages[-2 * HISTORY_MAX_TURNS:]
+
+    memory = ConversationBufferMemory(
+        memory_key="chat_history",
+        return_messages=True,
+        output_key="answer"
+    )
+    if mode == "summary" and entry["summary"]:
+        memory.chat_memory.add_message(SystemMessage(content=entry["summary"]))
+    for sender, content in messages:
+        if sender == "user":
+            memory.chat_memory.add_user_message(content)
+        elif sender == "ai":
+            memory.chat_memory.add_ai_message(content)
+    return memory
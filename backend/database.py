@@ -1,12 +1,28 @@
 from sqlalchemy import create_engine
 from fastapi import Depends
-from sqlalchemy.orm import sessionmaker,session
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from typing import Annotated
-URL="mysql+pymysql:///retriver"
-engine = create_engine(URL)
+from dotenv import load_dotenv
+import os
+load_dotenv()
+URL=os.getenv("DATABASE_URL", "mysql+pymysql:///retriver")
+ASYNC_URL=os.getenv("ASYNC_DATABASE_URL", URL.replace("+pymysql", "+aiomysql"))
+
+# Connection pool configuration
+pool_settings = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": True,
+}
+engine = create_engine(URL, **pool_settings)
+async_engine = create_async_engine(ASYNC_URL, **pool_settings)
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 def get_db():
     db = SessionLocal()
@@ -15,4 +31,9 @@ def get_db():
     finally:
         db.close()
 
-db_dependency = Annotated[session, Depends(get_db)]
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+db_dependency = Annotated[Session, Depends(get_db)]
+async_db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
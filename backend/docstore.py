@@ -0,0 +1,110 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from collections.abc import Mapping
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+logger = logging.getLogger(__name__)
+
+DOCSTORE_FILE = "docstore.sqlite"
+
+
+class SQLiteDocstore(Docstore):
+    """Read-only view of a saved docstore.
+
+    Chunk text and metadata stay on disk and are read by id only for the
+    hits a search returns. Files are replaced rather than modified, so the
+    database is opened immutable. Deletions hide ids from this view only;
+    the file itself is rewritten by compaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            f"{Path(path).absolute().as_uri()}?immutable=1", uri=True, check_same_thread=False
+        )
+        self._hidden = set()
+
+    def search(self, search):
+        if search in self._hidden:
+            return f"ID {search} not found."
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, metadata FROM chunks WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def delete(self, ids):
+        self._hidden.update(ids)
+
+    def position_map(self):
+        return ChunkIdMap(self)
+
+    def load_all(self):
+        """Docstore and position map held fully in memory, for rewriting the index"""
+        documents, positions = {}, {}
+        with self._lock:
+            rows = self._conn.execute("SELECT position, id, content, metadata FROM chunks ORDER BY position")
+            for position, chunk_id, content, metadata in rows:
+                documents[chunk_id] = Document(id=chunk_id, page_content=content, metadata=json.loads(metadata))
+                positions[position] = chunk_id
+        return InMemoryDocstore(documents), positions
+
+    def _rows(self, query, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+
+class ChunkIdMap(Mapping):
+    """FAISS position -> chunk id, looked up in the docstore file on demand"""
+
+    def __init__(self, docstore):
+        self._docstore = docstore
+
+    def __getitem__(self, position):
+        rows = self._docstore._rows("SELECT id FROM chunks WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __len__(self):
+        return self._docstore._rows("SELECT COUNT(*) FROM chunks")[0][0]
+
+    def __iter__(self):
+        return iter([row[0] for row in self._docstore._rows("SELECT position FROM chunks ORDER BY position")])
+
+    def items(self):
+        return self._docstore._rows("SELECT position, id FROM chunks ORDER BY position")
+
+    def values(self):
+        return [row[0] for row in self._docstore._rows("SELECT id FROM chunks ORDER BY position")]
+
+
+def write_docstore(path, docstore, index_to_docstore_id):
+    """Write chunks in FAISS position order to a new file and swap it in"""
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute(
+            "CREATE TABLE chunks (position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+            "content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        rows = []
+        for position, chunk_id in sorted(index_to_docstore_id.items()):
+            doc = docstore.search(chunk_id)
+            rows.append((position, chunk_id, doc.page_content, json.dumps(doc.metadata, default=str)))
+        conn.executemany("INSERT INTO chunks (position, id, content, metadata) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
@@ -0,0 +1,211 @@
+import os
+import time
+import random
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Embedding cache configuration
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "vector_stores/embedding_cache.sqlite")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+EMBED_BACKOFF_SECONDS = float(os.getenv("EMBED_BACKOFF_SECONDS", "1.0"))
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "4096"))
+
+
+def embedding_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def normalize_query(text):
+    """Collapse whitespace so trivially different questions share an embedding"""
+    return " ".join(text.split())
+
+
+class EmbeddingStore:
+    """Persistent map from embedding key to vector, stored in SQLite"""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+        return self._conn
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items],
+            )
+            conn.commit()
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic local embeddings for tests and offline runs"""
+
+    def __init__(self, size=1536):
+        self.size = size
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """Content-addressed cache in front of an embedding backend.
+
+    Document embeddings are looked up by a hash of (model, text). Misses are
+    deduplicated, sent to the backend in batches of batch_size with up to
+    concurrency batches in flight, and retried with exponential backoff.
+    Query embeddings are kept in an in-process LRU of query_cache_size
+    entries keyed by normalized text.
+    """
+
+    def __init__(self, underlying, model, store,
+                 batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY,
+                 max_retries=EMBED_MAX_RETRIES, backoff_seconds=EMBED_BACKOFF_SECONDS,
+                 query_cache_size=QUERY_EMBED_CACHE_SIZE):
+        self.underlying = underlying
+        self.model = model
+        self.store = store
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_lock = threading.Lock()
+        self.query_hits = 0
+        self.query_misses = 0
+
+    def _embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.underlying.embed_documents(texts)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"Embedding batch failed ({str(e)}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed_documents(self, texts, on_progress=None):
+        """Embed texts, calling on_progress(done) as batches complete"""
+        keys = [embedding_key(self.model, text) for text in texts]
+        vectors = self.store.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        done = len(texts) - sum(1 for key in keys if key in missing)
+        if on_progress:
+            on_progress(done)
+
+        if missing:
+            logger.info(f"Embedding {len(missing)} of {len(texts)} texts, rest served from cache")
+            missing_keys = list(missing)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {
+                    executor.submit(self._embed_batch, [missing[key] for key in batch]): batch
+                    for batch in batches
+                }
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    embedded = list(zip(batch, future.result()))
+                    self.store.put_many(embedded)
+                    vectors.update(embedded)
+                    batch_keys = set(batch)
+                    done += sum(1 for key in keys if key in batch_keys)
+                    if on_progress:
+                        on_progress(done)
+
+        return [vectors[key] for key in keys]
+
+    def embed_queries(self, texts):
+        """Embed several questions, sending all LRU misses in one backend request"""
+        texts = [normalize_query(text) for text in texts]
+        vectors = {}
+        with self._query_lock:
+            for text in texts:
+                if text in self._query_cache:
+                    self._query_cache.move_to_end(text)
+                    vectors[text] = self._query_cache[text]
+                    self.query_hits += 1
+                else:
+                    self.query_misses += 1
+        missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+        if missing:
+            embedded = self._embed_batch(missing)
+            with self._query_lock:
+                for text, vector in zip(missing, embedded):
+                    vectors[text] = vector
+                    self._query_cache[text] = vector
+                    self._query_cache.move_to_end(text)
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        return [vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def query_cache_stats(self):
+        with self._query_lock:
+            lookups = self.query_hits + self.query_misses
+            return {
+                "entries": len(self._query_cache),
+                "max_entries": self.query_cache_size,
+                "hits": self.query_hits,
+                "misses": self.query_misses,
+                "hit_rate": self.query_hits / lookups if lookups else 0.0,
+            }
+
+
+embedding_store = EmbeddingStore()
@@ -0,0 +1,78 @@
+import os
+import json
+import base64
+import logging
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, or_, and_
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Pagination configuration
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "500"))
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing just after row in (created_at, id) order"""
+    raw = json.dumps([row.created_at.isoformat(), row.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _page_query(model, condition, limit, cursor):
+    # Keyset pagination: seek past the last row seen using the
+    # (filter column, created_at, id) index instead of an OFFSET scan
+    query = select(model).where(condition)
+    if cursor is not None:
+        created_at, row_id = cursor
+        query = query.where(or_(
+            model.created_at > created_at,
+            and_(model.created_at == created_at, model.id > row_id),
+        ))
+    return query.order_by(model.created_at, model.id).limit(limit)
+
+
+async def fetch_page(db, model, condition, limit, cursor=None):
+    """One page of rows in creation order, plus the cursor of the next page.
+
+    db is an AsyncSession. next_cursor is None on the last page.
+    """
+    seek = decode_cursor(cursor) if cursor else None
+    # Fetch one extra row to know whether another page follows
+    rows = (await db.scalars(_page_query(model, condition, limit + 1, seek))).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+async def stream_rows(model, condition, page_size, cursor=None):
+    """Every row after cursor as NDJSON lines, read one page at a time.
+
+    Opens its own session: a streamed response outlives the request's
+    dependencies.
+    """
+    seek = decode_cursor(cursor) if cursor else None
+
+    async def lines():
+        nonlocal seek
+        async with AsyncSessionLocal() as db:
+            while True:
+                rows = (await db.scalars(_page_query(model, condition, page_size, seek))).all()
+                for row in rows:
+                    yield json.dumps(jsonable_encoder(row)) + "\n"
+                if len(rows) < page_size:
+                    return
+                seek = (rows[-1].created_at, rows[-1].id)
+                # Pages are read in separate statements; don't hold the rows
+                db.expunge_all()
+
+    return lines()
@@ -0,0 +1,109 @@
+import os
+import json
+import math
+import logging
+import numpy as np
+import faiss
+
+logger = logging.getLogger(__name__)
+
+# Index type selection: auto picks by corpus size, or force flat | hnsw | ivfpq
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+# Per-user overrides as JSON, e.g. {"alice": "hnsw"}
+FAISS_USER_INDEX_TYPES = json.loads(os.getenv("FAISS_USER_INDEX_TYPES", "{}"))
+FAISS_HNSW_MIN_VECTORS = int(os.getenv("FAISS_HNSW_MIN_VECTORS", "10000"))
+FAISS_IVFPQ_MIN_VECTORS = int(os.getenv("FAISS_IVFPQ_MIN_VECTORS", "200000"))
+
+# Tuning
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", "16"))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "64"))
+FAISS_PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", "8"))
+FAISS_TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", "100000"))
+
+CONFIG_FILE = "index_config.json"
+FLAT_CONFIG = {"index_type": "flat"}
+
+
+def choose_index_config(num_vectors, username=None):
+    """Pick the index type and its parameters for a corpus of num_vectors"""
+    index_type = FAISS_USER_INDEX_TYPES.get(username, FAISS_INDEX_TYPE)
+    if index_type == "auto":
+        if num_vectors >= FAISS_IVFPQ_MIN_VECTORS:
+            index_type = "ivfpq"
+        elif num_vectors >= FAISS_HNSW_MIN_VECTORS:
+            index_type = "hnsw"
+        else:
+            index_type = "flat"
+    if index_type == "ivfpq" and num_vectors < 2 ** FAISS_PQ_NBITS:
+        # Too few vectors to train the product quantizer
+        index_type = "flat"
+
+    config = {"index_type": index_type, "num_vectors": num_vectors}
+    if index_type == "hnsw":
+        config.update(m=FAISS_HNSW_M, ef_construction=FAISS_HNSW_EF_CONSTRUCTION, ef_search=FAISS_HNSW_EF_SEARCH)
+    elif index_type == "ivfpq":
+        # ~4*sqrt(n) lists, keeping at least 39 training points per list
+        nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+        config.update(nlist=nlist, nprobe=min(FAISS_IVF_NPROBE, nlist), pq_m=FAISS_PQ_M, pq_nbits=FAISS_PQ_NBITS)
+    elif index_type != "flat":
+        raise ValueError(f"Unknown FAISS index type: {index_type}")
+    return config
+
+
+def supports_remove(config):
+    """HNSW graphs cannot drop vectors in place; they are rebuilt instead"""
+    return config["index_type"] != "hnsw"
+
+
+def build_index(dimension, config, training_vectors=None):
+    """Create an empty (trained, where needed) FAISS index for a config"""
+    index_type = config["index_type"]
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dimension)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, config["m"])
+        index.hnsw.efConstruction = config["ef_construction"]
+        apply_search_params(index, config)
+        return index
+
+    # IVF with product quantization; sub-quantizers must divide the dimension
+    pq_m = config["pq_m"]
+    while dimension % pq_m:
+        pq_m -= 1
+    config["pq_m"] = pq_m
+    quantizer = faiss.IndexFlatL2(dimension)
+    index = faiss.IndexIVFPQ(quantizer, dimension, config["nlist"], pq_m, config["pq_nbits"])
+    sample = np.asarray(training_vectors, dtype=np.float32)
+    if len(sample) > FAISS_TRAIN_SAMPLE:
+        rows = np.random.default_rng(0).choice(len(sample), FAISS_TRAIN_SAMPLE, replace=False)
+        sample = sample[rows]
+    logger.info(f"Training IVF-PQ index on {len(sample)} vectors, nlist={config['nlist']}, m={pq_m}")
+    index.train(sample)
+    apply_search_params(index, config)
+    return index
+
+
+def apply_search_params(index, config):
+    if config["index_type"] == "hnsw":
+        index.hnsw.efSearch = config["ef_search"]
+    elif config["index_type"] == "ivfpq":
+        index.nprobe = config["nprobe"]
+
+
+def load_index_config(index_path):
+    path = os.path.join(index_path, CONFIG_FILE)
+    if not os.path.exists(path):
+        return dict(FLAT_CONFIG)
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index_config(index_path, config):
+    path = os.path.join(index_path, CONFIG_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f)
+    os.replace(tmp_path, path)
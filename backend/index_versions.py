@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every save of an index goes to a new directory under versions/; the
+# CURRENT file names the live one and is replaced atomically, so readers in
+# any worker see either the old index or the new one, never a mix
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+# How long a superseded version is kept for readers that looked up the
+# pointer just before it moved
+INDEX_VERSION_RETENTION_SECONDS = float(os.getenv("INDEX_VERSION_RETENTION_SECONDS", "300"))
+
+# Files that are not part of an index version
+_UNVERSIONED = {CURRENT_FILE, VERSIONS_DIR, "manifest.json"}
+
+
+def current_version(path):
+    """(version id, directory) of the live index saved at path.
+
+    Indexes saved before versioning keep their files in path itself and
+    are identified by their latest modification time. Raises
+    FileNotFoundError when there is no index at path.
+    """
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            version = f.read().strip()
+        return version, os.path.join(path, VERSIONS_DIR, version)
+    except FileNotFoundError:
+        pass
+    files = [name for name in os.listdir(path) if name not in _UNVERSIONED and ".tmp" not in name]
+    if not files:
+        raise FileNotFoundError(f"No index saved at {path}")
+    mtime = max(os.path.getmtime(os.path.join(path, name)) for name in files)
+    return f"unversioned-{mtime}", path
+
+
+def index_exists(path):
+    try:
+        current_version(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def new_version_dir(path):
+    """Create the directory for the next version of the index at path.
+
+    Call it once the index is built, just before writing its files. It
+    only creates the directory; a version left unpublished by a failed
+    save is removed by publish_version's pruning once it is older than
+    the retention period.
+    """
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    directory = os.path.join(path, VERSIONS_DIR, version)
+    os.makedirs(directory)
+    return version, directory
+
+
+def _fsync_dir_files(directory):
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def publish_version(path, version):
+    """Make version the live index at path, then prune superseded versions"""
+    directory = os.path.join(path, VERSIONS_DIR, version)
+    # The pointer must never name files that are not fully on disk
+    _fsync_dir_files(directory)
+    try:
+        previous, previous_dir = current_version(path)
+    except FileNotFoundError:
+        previous_dir = None
+    pointer = os.path.join(path, CURRENT_FILE)
+    tmp_path = f"{pointer}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer)
+    if previous_dir is not None and previous_dir != path:
+        # Start the superseded version's retention period now
+        os.utime(previous_dir)
+    prune_versions(path)
+
+
+def prune_versions(path, retention_seconds=INDEX_VERSION_RETENTION_SECONDS):
+    """Remove versions other than the live one once their retention has passed"""
+    versions_path = os.path.join(path, VERSIONS_DIR)
+    if not os.path.isdir(versions_path):
+        return
+    live, _ = current_version(path)
+    cutoff = time.time() - retention_seconds
+    for name in os.listdir(versions_path):
+        directory = os.path.join(versions_path, name)
+        if name != live and os.path.getmtime(directory) < cutoff:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def remove_index(path):
+    """Delete an index directory without exposing a half-deleted tree.
+
+    The directory is renamed away first, so readers either open the
+    complete index or find none. Files they already opened or mapped stay
+    readable until closed.
+    """
+    if not os.path.exists(path):
+        return False
+    trash = f"{path}.deleted-{uuid.uuid4().hex}"
+    os.replace(path, trash)
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
@@ -0,0 +1,429 @@
+import os
+import time
+import uuid
+import queue
+import base64
+import asyncio
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from azure.storage.blob import BlobBlock
+from starlette.concurrency import run_in_threadpool
+from langchain_core.documents import Document
+from database import SessionLocal
+from models import IngestJob, Conversation
+from clients import get_blob_service_client, CONTAINER_NAME
+from vector_store import get_embeddings, split_documents, add_embedded_chunks
+from embedding_cache import EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+from pdf_parsing import page_count, parse_page_range
+from metrics import stage, observe, INGESTED_PAGES, INGESTED_CHUNKS
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Worker pool configuration
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "16"))
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "ingest_spool")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+PAGE_PROGRESS_INTERVAL = 10
+# A running job's worker refreshes updated_at while it works; a job not
+# refreshed for this long is taken to be orphaned and may be claimed again
+INGEST_JOB_LEASE_SECONDS = float(os.getenv("INGEST_JOB_LEASE_SECONDS", "300"))
+
+# Pipeline configuration: pages are parsed in a process pool, chunked as
+# they arrive and embedded in batches while later pages are still parsing
+INGEST_PARSE_PROCESSES = int(os.getenv("INGEST_PARSE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "8"))
+INGEST_QUEUE_PAGES = int(os.getenv("INGEST_QUEUE_PAGES", "64"))
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_embed_executor = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="ingest-embed")
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+_END_OF_PAGES = object()
+# Set once the process is stopping: jobs cut short are left for the next start
+_shutting_down = threading.Event()
+_pending_lock = threading.Lock()
+_pending = 0
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+def _reserve_slot(force=False):
+    global _pending
+    with _pending_lock:
+        if not force and _pending >= INGEST_MAX_PENDING:
+            raise IngestQueueFull("Ingestion queue is full, try again later")
+        _pending += 1
+
+
+def _release_slot():
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def _get_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn, not fork: the parent process runs threads and event loops
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=INGEST_PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _parse_pool
+
+
+def _discard_parse_pool(pool):
+    """Drop a pool whose worker died, so the next job starts a fresh one"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _put(page_queue, item, stop):
+    """Block on a full queue until there is room or the consumer has given up"""
+    while not stop.is_set():
+        try:
+            page_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _parse_pages(path, page_queue, stop):
+    """Parse page ranges in the process pool, feeding pages to page_queue in order"""
+    started = time.perf_counter()
+    pool = None
+    try:
+        pool = _get_parse_pool()
+        in_flight = deque()
+        for start in range(0, page_count(path), INGEST_PAGES_PER_TASK):
+            in_flight.append(pool.submit(parse_page_range, path, start, start + INGEST_PAGES_PER_TASK))
+            # Parse a little ahead of the consumer, not the whole file
+            if len(in_flight) < 2 * INGEST_PARSE_PROCESSES:
+                continue
+            for page in in_flight.popleft().result():
+                if not _put(page_queue, page, stop):
+                    return
+        while in_flight:
+            for page in in_flight.popleft().result():
+                if not _put(page_queue, page, stop):
+                    return
+        observe("ingest", "parse", time.perf_counter() - started)
+        _put(page_queue, _END_OF_PAGES, stop)
+    except BrokenProcessPool as e:
+        # A parse worker died (out of memory, a crash in the PDF library);
+        # a broken pool never recovers
+        _discard_parse_pool(pool)
+        _put(page_queue, e, stop)
+    except Exception as e:
+        _put(page_queue, e, stop)
+
+
+def _ingest_pdf(db, job):
+    """Parse, chunk and embed a spooled PDF as a pipeline, then index it.
+
+    Stages are joined by bounded queues: at most INGEST_QUEUE_PAGES parsed
+    pages wait for chunking and EMBED_CONCURRENCY batches are embedding at
+    once, so a slow stage holds back the ones before it.
+    """
+    page_queue = queue.Queue(maxsize=INGEST_QUEUE_PAGES)
+    stop = threading.Event()
+    threading.Thread(
+        target=_parse_pages, args=(job.spool_path, page_queue, stop), name=f"parse-{job.id}", daemon=True
+    ).start()
+
+    embeddings = get_embeddings()
+    embed_slots = threading.Semaphore(EMBED_CONCURRENCY)
+    batches = []
+    pending = []
+    pages = chunks_total = 0
+
+    def embed(texts):
+        with stage("ingest", "embed_batch"):
+            return embeddings.embed_documents(texts)
+
+    def submit(chunks):
+        embed_slots.acquire()
+        future = _embed_executor.submit(embed, [chunk.page_content for chunk in chunks])
+        future.add_done_callback(lambda _: embed_slots.release())
+        batches.append((chunks, future))
+
+    def embedded():
+        return sum(len(chunks) for chunks, future in batches if future.done() and not future.exception())
+
+    try:
+        while True:
+            item = page_queue.get()
+            if item is _END_OF_PAGES:
+                break
+            if isinstance(item, Exception):
+                raise item
+            text, metadata = item
+            pages += 1
+            if text.strip():
+                with stage("ingest", "split_page"):
+                    chunks = split_documents([Document(page_content=text, metadata=metadata)], job.file_name)
+                chunks_total += len(chunks)
+                pending.extend(chunks)
+                while len(pending) >= EMBED_BATCH_SIZE:
+                    submit(pending[:EMBED_BATCH_SIZE])
+                    pending = pending[EMBED_BATCH_SIZE:]
+            if pages % PAGE_PROGRESS_INTERVAL == 0:
+                _update_job(db, job, pages_parsed=pages, chunks_total=chunks_total, chunks_embedded=embedded())
+        if pending:
+            submit(pending)
+
+        if not pages:
+            raise ValueError("No documents were loaded from the PDF")
+        if not chunks_total:
+            raise ValueError("No chunks were created from documents")
+        logger.info(f"Parsed {pages} pages into {chunks_total} chunks for user: {job.username}")
+        _update_job(db, job, stage="embedding", pages_parsed=pages, chunks_total=chunks_total, chunks_embedded=embedded())
+
+        text_embeddings, metadatas, done = [], [], 0
+        for chunks, future in batches:
+            vectors = future.result()
+            text_embeddings.extend(zip([chunk.page_content for chunk in chunks], vectors))
+            metadatas.extend(chunk.metadata for chunk in chunks)
+            done += len(chunks)
+            _update_job(db, job, chunks_embedded=done)
+
+        with stage("ingest", "index_write"):
+            add_embedded_chunks(job.username, job.file_name, text_embeddings, metadatas)
+        _update_job(db, job, index_saved=True)
+        INGESTED_PAGES.inc(pages)
+        INGESTED_CHUNKS.inc(chunks_total)
+    finally:
+        stop.set()
+
+
+def _update_job(db, job, **fields):
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.updated_at = datetime.now(timezone.utc)
+    db.commit()
+
+
+def _set_job_if(db, job_id, current, **fields):
+    """Update a job only while its status is current; False when another worker changed it first"""
+    fields["updated_at"] = datetime.now(timezone.utc)
+    changed = (
+        db.query(IngestJob)
+        .filter(IngestJob.id == job_id, IngestJob.status == current)
+        .update(fields, synchronize_session=False)
+    )
+    db.commit()
+    return changed == 1
+
+
+def _heartbeat(job_id, stop):
+    """Keep a running job's lease while this worker processes it"""
+    while not stop.wait(INGEST_JOB_LEASE_SECONDS / 3):
+        try:
+            with SessionLocal() as db:
+                _set_job_if(db, job_id, "running")
+        except Exception as e:
+            logger.warning(f"Could not renew the lease of ingestion job {job_id}: {str(e)}")
+
+
+def _remove_spool(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _spool_and_upload(file, spool_path, blob_name):
+    """Stream an upload to the spool file and blob storage in one pass.
+
+    Each chunk is written to disk and staged as a blob block while the next
+    chunk is read, so at most two chunks are held in memory.
+    """
+    blob_client = get_blob_service_client().get_blob_client(container=CONTAINER_NAME, blob=blob_name)
+    blocks = []
+    staging = None
+    with open(spool_path, "wb") as spool:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(spool.write, chunk)
+            if staging is not None:
+                await staging
+            block_id = base64.b64encode(f"{len(blocks):08d}".encode()).decode()
+            blocks.append(BlobBlock(block_id=block_id))
+            staging = asyncio.ensure_future(blob_client.stage_block(block_id, chunk))
+    if staging is not None:
+        await staging
+    await blob_client.commit_block_list(blocks)
+
+
+async def enqueue_upload(db, user, file):
+    """Spool an uploaded PDF, create its conversation and queue ingestion.
+
+    db is an AsyncSession. Returns (job_id, conversation_id). Raises
+    IngestQueueFull when the bounded queue has no room.
+    """
+    _reserve_slot()
+    spool_path = None
+    try:
+        job_id = str(uuid.uuid4())
+        os.makedirs(INGEST_SPOOL_DIR, exist_ok=True)
+        spool_path = os.path.join(INGEST_SPOOL_DIR, f"{job_id}.pdf")
+        with stage("upload", "blob_upload"):
+            await _spool_and_upload(file, spool_path, f"{user['username']}/{file.filename}")
+
+        with stage("upload", "db_write"):
+            conversation = Conversation(
+                user_id=user['id'],
+                file_name=file.filename,
+                title=f'analysis_{file.filename}'
+            )
+            db.add(conversation)
+            await db.flush()
+            job = IngestJob(
+                id=job_id,
+                user_id=user['id'],
+                username=user['username'],
+                conversation_id=conversation.id,
+                file_name=file.filename,
+                spool_path=spool_path,
+            )
+            db.add(job)
+            await db.commit()
+        _executor.submit(_run_job, job_id)
+        return job_id, conversation.id
+    except Exception:
+        _release_slot()
+        if spool_path is not None:
+            _remove_spool(spool_path)
+        raise
+
+
+def _run_job(job_id):
+    db = SessionLocal()
+    stop_heartbeat = threading.Event()
+    try:
+        # Every worker requeues unfinished jobs at startup; only the one
+        # that moves the job out of "queued" runs it
+        if not _set_job_if(db, job_id, "queued", status="running", stage="parsing", pages_parsed=0):
+            return
+        job = db.get(IngestJob, job_id)
+        threading.Thread(
+            target=_heartbeat, args=(job_id, stop_heartbeat), name=f"lease-{job_id}", daemon=True
+        ).start()
+        try:
+            # The upload already reached blob storage; parse the spooled copy
+            with stage("ingest", "total"):
+                try:
+                    _ingest_pdf(db, job)
+                except BrokenProcessPool as e:
+                    # Retry once on a fresh pool in case another job's PDF
+                    # took the worker down
+                    logger.warning(f"Ingestion job {job_id} lost its parse pool, retrying: {str(e)}")
+                    db.rollback()
+                    _update_job(db, job, stage="parsing", pages_parsed=0)
+                    _ingest_pdf(db, job)
+            _set_job_if(db, job_id, "running", status="done", stage="ready")
+            logger.info(f"Ingestion job {job_id} finished for user: {job.username}")
+
+        except Exception as e:
+            db.rollback()
+            if _shutting_down.is_set():
+                # Interrupted by shutdown, not failed: keep the spool file
+                # so the next start resumes it
+                logger.info(f"Ingestion job {job_id} interrupted by shutdown, requeued")
+                _set_job_if(db, job_id, "running", status="queued", stage="queued")
+                return
+            logger.error(f"Ingestion job {job_id} failed: {str(e)}")
+            # Never downgrade a job another worker has finished
+            _set_job_if(db, job_id, "running", status="failed", error=str(e)[:1000])
+        _remove_spool(job.spool_path)
+    finally:
+        stop_heartbeat.set()
+        db.close()
+        _release_slot()
+
+
+async def get_job(db, job_id):
+    return await db.get(IngestJob, job_id)
+
+
+def pending_job_for_conversation(db, conversation_id):
+    """Latest ingestion job for a conversation unless it finished; it may be queued, running or failed"""
+    job = (
+        db.query(IngestJob)
+        .filter(IngestJob.conversation_id == conversation_id)
+        .order_by(IngestJob.created_at.desc())
+        .first()
+    )
+    return None if job is None or job.status == "done" else job
+
+
+def job_status(job):
+    return {
+        "job_id": job.id,
+        "conversation_id": job.conversation_id,
+        "file_name": job.file_name,
+        "status": job.status,
+        "stage": job.stage,
+        "pages_parsed": job.pages_parsed,
+        "chunks_total": job.chunks_total,
+        "chunks_embedded": job.chunks_embedded,
+        "index_saved": job.index_saved,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+
+def resume_jobs():
+    """Requeue jobs left unfinished by a stopped process.
+
+    Runs in every worker at startup. Running jobs are only taken back once
+    their lease has expired, so jobs a live worker is processing are left
+    alone; each queued job is run by whichever worker claims it first.
+    """
+    db = SessionLocal()
+    try:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=INGEST_JOB_LEASE_SECONDS)
+        orphaned = (
+            db.query(IngestJob)
+            .filter(IngestJob.status == "running", IngestJob.updated_at < cutoff)
+            .update({"status": "queued", "stage": "queued"}, synchronize_session=False)
+        )
+        db.commit()
+        jobs = db.query(IngestJob).filter(IngestJob.status == "queued").all()
+        for job in jobs:
+            if not os.path.exists(job.spool_path):
+                _set_job_if(db, job.id, "queued", status="failed", error="Uploaded file was lost before processing")
+                continue
+            _reserve_slot(force=True)
+            _executor.submit(_run_job, job.id)
+        if jobs:
+            logger.info(f"Requeued {len(jobs)} ingestion jobs ({orphaned} orphaned while running)")
+    finally:
+        db.close()
+
+
+def shutdown_workers():
+    # Jobs cut short by the cancelled executors go back to "queued" with
+    # their spool files and are resumed on next start
+    _shutting_down.set()
+    _executor.shutdown(wait=False, cancel_futures=True)
+    _embed_executor.shutdown(wait=False, cancel_futures=True)
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,204 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from metrics import observe, LLM_SHED
+
+logger = logging.getLogger(__name__)
+
+# Admission control for LLM work: how many answers run at once overall and
+# per user, how many may wait for a slot and for how long. The limits apply
+# to each server worker process on its own; divide the provider's capacity
+# by the number of workers when setting them
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_USER_CONCURRENCY = int(os.getenv("LLM_USER_CONCURRENCY", "4"))
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "64"))
+LLM_USER_MAX_WAITING = int(os.getenv("LLM_USER_MAX_WAITING", "8"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+# Time an admitted answer may take, all of its LLM calls included
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+# Timeout of a single call to the provider
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+
+
+class LLMOverloaded(Exception):
+    """No LLM slot is available; retry after retry_after seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    """Admits LLM work under global and per-user concurrency limits.
+
+    Work that cannot start waits in one FIFO queue, but a waiter whose user
+    is at their limit does not hold up other users behind it. The queue is
+    bounded overall and per user: past those bounds, or after waiting
+    queue_timeout seconds, LLMOverloaded is raised so callers can shed load
+    instead of piling up blocked requests. Unbounded waiters, the calls of
+    an already admitted batch, queue for slots in the same order but are not
+    counted against those bounds.
+
+    State lives in the process, so every server worker enforces the limits
+    separately.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, user_concurrency=LLM_USER_CONCURRENCY,
+                 max_waiting=LLM_MAX_WAITING, user_max_waiting=LLM_USER_MAX_WAITING,
+                 queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.user_concurrency = user_concurrency
+        self.max_waiting = max_waiting
+        self.user_max_waiting = user_max_waiting
+        self.queue_timeout = queue_timeout
+        self._running = 0
+        self._user_running = Counter()
+        # Bounded waiters only, for the queue limits
+        self._waiting = 0
+        self._user_waiting = Counter()
+        self._waiters = deque()  # (user, future)
+        # Moving average of how long a slot is held, for Retry-After
+        self._avg_hold = 5.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _can_run(self, user):
+        return self._running < self.max_concurrency and self._user_running[user] < self.user_concurrency
+
+    def _grant(self, user):
+        self._running += 1
+        self._user_running[user] += 1
+        self.admitted += 1
+
+    def retry_after(self):
+        """Seconds until a queued request could expect a slot, at least 1"""
+        backlog = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, min(60, math.ceil(self._avg_hold * backlog)))
+
+    def check_admission(self, user):
+        """Raise LLMOverloaded when a new request from user would be turned away"""
+        if self._can_run(user):
+            return
+        if self._waiting >= self.max_waiting or self._user_waiting[user] >= self.user_max_waiting:
+            self.rejected += 1
+            reason = "queue_full" if self._waiting >= self.max_waiting else "user_queue_full"
+            LLM_SHED.labels(reason).inc()
+            raise LLMOverloaded("Too many requests are waiting for the model, try again later", self.retry_after())
+
+    async def acquire(self, user, bounded=True):
+        """Wait for a slot for user.
+
+        Unbounded waits skip the queue limits and the queue timeout; they
+        are for work that was already admitted and bounds its own fan-out.
+        """
+        # Waiters are granted as soon as they can run, so any still queued
+        # are blocked on a limit this user does not share
+        if self._can_run(user):
+            self._grant(user)
+            return
+        if bounded:
+            self.check_admission(user)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((user, future))
+        if bounded:
+            self._waiting += 1
+            self._user_waiting[user] += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout if bounded else None)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted in the same loop iteration the timeout fired;
+                # some Python versions still raise, so take the slot
+                return
+            self.timed_out += 1
+            LLM_SHED.labels("queue_timeout").inc()
+            raise LLMOverloaded("Timed out waiting for the model, try again later", self.retry_after())
+        except asyncio.CancelledError:
+            # Granted just as the waiter gave up: hand the slot on
+            if future.done() and not future.cancelled():
+                self.release(user)
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                self._remove_waiter(future)
+            if bounded:
+                self._waiting -= 1
+                self._user_waiting[user] -= 1
+                if self._user_waiting[user] <= 0:
+                    self._user_waiting.pop(user, None)
+            observe("llm", "queue_wait", time.perf_counter() - started)
+
+    def _remove_waiter(self, future):
+        for waiter in self._waiters:
+            if waiter[1] is future:
+                self._waiters.remove(waiter)
+                return
+
+    def release(self, user, held_seconds=None):
+        self._running -= 1
+        self._user_running[user] -= 1
+        if self._user_running[user] <= 0:
+            self._user_running.pop(user, None)
+        if held_seconds is not None:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * held_seconds
+        self._wake()
+
+    def _wake(self):
+        # Grant waiters in arrival order, skipping users already at their limit
+        for user, future in list(self._waiters):
+            if self._running >= self.max_concurrency:
+                return
+            if future.done() or not self._can_run(user):
+                continue
+            self._waiters.remove((user, future))
+            self._grant(user)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user, bounded=True):
+        """Hold an LLM slot for user while the block runs"""
+        await self.acquire(user, bounded)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(user, time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "user_concurrency": self.user_concurrency,
+            "running": self._running,
+            "waiting": self._waiting,
+            "batch_waiting": len(self._waiters) - self._waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_hold_seconds": round(self._avg_hold, 3),
+        }
+
+
+async def until_deadline(events, seconds=LLM_DEADLINE_SECONDS):
+    """Items of an async iterator, raising TimeoutError once seconds have passed.
+
+    asyncio.timeout can't wrap a generator that yields to its consumer: the
+    cancellation would land in the consumer. Each item is waited for
+    instead.
+    """
+    deadline = time.monotonic() + seconds
+    iterator = events.__aiter__()
+    while True:
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), max(0.0, deadline - time.monotonic()))
+        except StopAsyncIteration:
+            return
+        yield item
+
+
+llm_scheduler = LLMScheduler()
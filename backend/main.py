@@ -1,9 +1,44 @@
-from fastapi import FastAPI
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from database import Base, engine
 from routes import auth, rag, trial
 from fastapi.middleware.cors import CORSMiddleware
+from ingestion import resume_jobs, shutdown_workers
+from vector_store import compact_all_vector_dbs, get_embeddings
+from clients import open_clients, close_clients
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from metrics import ServerTimingMiddleware, cache_stats_collector
+from vector_cache import vector_cache
+from models import create_missing_indexes
+from chat_writer import CHAT_WRITE_BEHIND, chat_writer
+from answer_cache import answer_cache
 Base.metadata.create_all(bind=engine)
-app=FastAPI()
+create_missing_indexes(engine)
+
+INDEX_COMPACT_INTERVAL = float(os.getenv("INDEX_COMPACT_INTERVAL", "600"))
+
+async def compact_periodically():
+    while True:
+        await asyncio.sleep(INDEX_COMPACT_INTERVAL)
+        await asyncio.to_thread(compact_all_vector_dbs)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_clients()
+    resume_jobs()
+    if CHAT_WRITE_BEHIND:
+        chat_writer.start()
+    compaction = asyncio.create_task(compact_periodically())
+    yield
+    compaction.cancel()
+    shutdown_workers()
+    # Queued chat turns are written before the process exits
+    await asyncio.to_thread(chat_writer.close)
+    await close_clients()
+
+app=FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -16,6 +51,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(ServerTimingMiddleware)
 app.include_router(auth.router,prefix='/auth',tags=['auth'])
-app.include_router(trial.router,prefix='/rag',tags=['rag'])
\ No newline at end of file
+app.include_router(trial.router,prefix='/rag',tags=['rag'])
+
+cache_stats_collector.register("vector_store", vector_cache.stats)
+cache_stats_collector.register("answer", answer_cache.stats)
+cache_stats_collector.register("query_embedding", lambda: get_embeddings().query_cache_stats())
+
+@app.get('/metrics')
+def metrics():
+    """Prometheus metrics: stage latency histograms, token, chunk and cache counters"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,162 @@
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "retriver_stage_seconds",
+    "Time spent in each stage of an upload, ingestion or query",
+    ["operation", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+INGESTED_PAGES = Counter("retriver_ingested_pages_total", "PDF pages parsed by ingestion jobs")
+INGESTED_CHUNKS = Counter("retriver_ingested_chunks_total", "Chunks embedded and indexed by ingestion jobs")
+LLM_CALLS = Counter("retriver_llm_calls_total", "LLM calls made to answer questions", ["mode"])
+LLM_TOKENS = Counter("retriver_llm_tokens_total", "LLM tokens used to answer questions", ["mode", "kind"])
+LLM_SHED = Counter("retriver_llm_shed_total", "Requests turned away by LLM admission control", ["reason"])
+
+# Stage timings of the request being served, for its Server-Timing header
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def observe(operation, name, seconds):
+    STAGE_SECONDS.labels(operation, name).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(operation, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(operation, name, time.perf_counter() - started)
+
+
+def record_usage(report):
+    """Count the LLM calls and tokens of one answered question"""
+    mode = report["mode"]
+    LLM_CALLS.labels(mode).inc(report["llm_calls"])
+    LLM_TOKENS.labels(mode, "prompt").inc(report["prompt_tokens"])
+    LLM_TOKENS.labels(mode, "completion").inc(report["completion_tokens"])
+    LLM_TOKENS.labels(mode, "context").inc(report["context_tokens"])
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    """Times retrieval and LLM calls made inside a chain"""
+
+    # Run in the request's context so timings reach its Server-Timing header
+    run_inline = True
+
+    def __init__(self, operation):
+        self.operation = operation
+        self._started = {}
+
+    def _start(self, run_id):
+        self._started[run_id] = time.perf_counter()
+
+    def _finish(self, run_id, name):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            observe(self.operation, name, time.perf_counter() - started)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._finish(run_id, "retrieval")
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id, "llm")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+
+
+class CacheStatsCollector:
+    """Exports hit/miss counters of the in-process caches on each scrape"""
+
+    def __init__(self):
+        self._sources = {}
+
+    def register(self, name, stats):
+        self._sources[name] = stats
+
+    def collect(self):
+        hits = CounterMetricFamily("retriver_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("retriver_cache_misses", "Cache misses", labels=["cache"])
+        hit_rate = GaugeMetricFamily("retriver_cache_hit_ratio", "Cache hit ratio since start", labels=["cache"])
+        entries = GaugeMetricFamily("retriver_cache_entries", "Entries held by the cache", labels=["cache"])
+        for name, stats in self._sources.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Error collecting {name} cache stats: {str(e)}")
+                continue
+            hits.add_metric([name], values["hits"])
+            misses.add_metric([name], values["misses"])
+            hit_rate.add_metric([name], values["hit_rate"])
+            entries.add_metric([name], values["entries"])
+        yield from (hits, misses, hit_rate, entries)
+
+
+cache_stats_collector = CacheStatsCollector()
+REGISTRY.register(cache_stats_collector)
+
+
+def server_timing_header(timings, total):
+    """Server-Timing value with stages summed by name, in first-seen order"""
+    durations = {}
+    counts = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+        counts[name] = counts.get(name, 0) + 1
+    entries = [
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="{counts[name]} calls"' if counts[name] > 1 else "")
+        for name, seconds in durations.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header listing the stages timed while serving a request.
+
+    Streaming responses send their headers first, so they only report the
+    stages that finished before the stream started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = []
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                header = server_timing_header(timings, time.perf_counter() - started)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
@@ -1,5 +1,5 @@
 from database import SessionLocal, engine, Base
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Index
 from pydantic import BaseModel, Field, EmailStr
 from typing import Annotated
 from datetime import datetime,timezone
@@ -27,7 +27,10 @@ class Conversation(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     file_name = Column(String(255), nullable=False)
     title = Column(String(255), nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    # Serves the per-user, creation-ordered conversation list
+    __table_args__ = (Index('ix_conversations_user_created', 'user_id', 'created_at', 'id'),)
 
 class message(Base):
     __tablename__ = 'messages'
@@ -35,4 +38,33 @@ class message(Base):
     conversation_id = Column(Integer, ForeignKey('conversations.id'))
     content = Column(String(10000), nullable=False)
     sender = Column(String(10), nullable=False)
-    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
\ No newline at end of file
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    # Serves history reads, paging and deletes by conversation
+    __table_args__ = (Index('ix_messages_conversation_created', 'conversation_id', 'created_at', 'id'),)
+
+
+class IngestJob(Base):
+    __tablename__ = 'ingest_jobs'
+    id = Column(String(36), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    username = Column(String(10), nullable=False)
+    conversation_id = Column(Integer, ForeignKey('conversations.id'), index=True)
+    file_name = Column(String(255), nullable=False)
+    spool_path = Column(String(512), nullable=False)
+    status = Column(String(20), nullable=False, default='queued')
+    stage = Column(String(20), nullable=False, default='queued')
+    pages_parsed = Column(Integer, nullable=False, default=0)
+    chunks_total = Column(Integer, nullable=False, default=0)
+    chunks_embedded = Column(Integer, nullable=False, default=0)
+    index_saved = Column(Boolean, nullable=False, default=False)
+    error = Column(String(1000))
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
+def create_missing_indexes(bind):
+    """Add indexes declared here to tables created before they existed"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
@@ -0,0 +1,27 @@
+from pypdf import PdfReader
+
+# Runs in the ingestion process pool; kept free of application imports so
+# worker processes start quickly
+
+
+def page_count(path):
+    return len(PdfReader(path).pages)
+
+
+def parse_page_range(path, start, stop):
+    """Text and metadata of pages [start, stop), in the shape PyPDFLoader produces"""
+    reader = PdfReader(path)
+    total_pages = len(reader.pages)
+    info = {
+        key.lstrip("/").lower(): str(value)
+        for key, value in (reader.metadata or {}).items()
+    }
+    pages = []
+    for number in range(start, min(stop, total_pages)):
+        metadata = dict(info, source=path, total_pages=total_pages, page=number)
+        try:
+            metadata["page_label"] = reader.page_labels[number]
+        except (IndexError, KeyError):
+            metadata["page_label"] = str(number + 1)
+        pages.append((reader.pages[number].extract_text(), metadata))
+    return pages
@@ -0,0 +1,134 @@
+import os
+import threading
+import logging
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage
+from conversation_memory import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# condense: rewrite follow-ups with an extra LLM call before retrieval
+# single: retrieve with the raw question and answer in one LLM call
+QUERY_MODE = os.getenv("QUERY_MODE", "condense")
+QUERY_MODES = ("condense", "single")
+# Follow-ups this short are treated as depending on the previous question
+FOLLOWUP_MAX_WORDS = int(os.getenv("FOLLOWUP_MAX_WORDS", "6"))
+REFERENCE_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their",
+    "he", "she", "him", "her", "his", "above", "previous", "same", "more",
+}
+
+
+def retrieval_query(question, history):
+    """Text to retrieve with in single-call mode.
+
+    Short or referential follow-ups are prefixed with the previous user
+    question so retrieval still sees the topic without an LLM rewrite.
+    """
+    previous = next((m.content for m in reversed(history) if isinstance(m, HumanMessage)), None)
+    if previous is None:
+        return question
+    words = [word.strip("?.,!;:'\"").lower() for word in question.split()]
+    if len(words) <= FOLLOWUP_MAX_WORDS or REFERENCE_WORDS.intersection(words):
+        return f"{previous} {question}"
+    return question
+
+
+class QueryUsage(BaseCallbackHandler):
+    """Counts LLM calls and tokens used while answering one question.
+
+    Prompt tokens are also counted locally with tiktoken, for providers
+    and fallbacks that report no usage, along with the tokens of the
+    retrieved context.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_prompt_tokens = 0
+        self.context_tokens = 0
+        self.context_chunks = 0
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        estimated = sum(count_tokens(str(message.content)) for batch in messages for message in batch)
+        with self._lock:
+            self.llm_calls += 1
+            self.estimated_prompt_tokens += estimated
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        estimated = sum(count_tokens(prompt) for prompt in prompts)
+        with self._lock:
+            self.llm_calls += 1
+            self.estimated_prompt_tokens += estimated
+
+    def on_retriever_end(self, documents, **kwargs):
+        with self._lock:
+            self.context_chunks += len(documents)
+            self.context_tokens += sum(doc.metadata.get("tokens", 0) for doc in documents)
+
+    def on_llm_end(self, response, **kwargs):
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if isinstance(message, AIMessage) and message.usage_metadata:
+                    prompt_tokens += message.usage_metadata.get("input_tokens", 0)
+                    completion_tokens += message.usage_metadata.get("output_tokens", 0)
+        if not prompt_tokens and not completion_tokens:
+            token_usage = (response.llm_output or {}).get("token_usage", {})
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def report(self, mode, latency_seconds):
+        return {
+            "mode": mode,
+            "latency_ms": round(latency_seconds * 1000, 1),
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "estimated_prompt_tokens": self.estimated_prompt_tokens,
+            "context_tokens": self.context_tokens,
+            "context_chunks": self.context_chunks,
+        }
+
+
+class QueryModeStats:
+    """Running latency and token totals per query mode"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, report):
+        with self._lock:
+            totals = self._totals.setdefault(report["mode"], {
+                "queries": 0, "latency_ms": 0.0, "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "estimated_prompt_tokens": 0, "context_tokens": 0,
+            })
+            totals["queries"] += 1
+            for name in ("latency_ms", "llm_calls", "prompt_tokens", "completion_tokens",
+                         "estimated_prompt_tokens", "context_tokens"):
+                totals[name] += report[name]
+
+    def stats(self):
+        with self._lock:
+            return {
+                mode: {
+                    "queries": totals["queries"],
+                    "avg_latency_ms": round(totals["latency_ms"] / totals["queries"], 1),
+                    "avg_llm_calls": totals["llm_calls"] / totals["queries"],
+                    "avg_prompt_tokens": totals["prompt_tokens"] / totals["queries"],
+                    "avg_completion_tokens": totals["completion_tokens"] / totals["queries"],
+                    "avg_estimated_prompt_tokens": totals["estimated_prompt_tokens"] / totals["queries"],
+                    "avg_context_tokens": totals["context_tokens"] / totals["queries"],
+                }
+                for mode, totals in self._totals.items()
+            }
+
+
+query_mode_stats = QueryModeStats()
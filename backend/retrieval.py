@@ -0,0 +1,145 @@
+import os
+import heapq
+import asyncio
+import logging
+from itertools import chain
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from vector_store import get_embeddings
+
+logger = logging.getLogger(__name__)
+
+# Query micro-batching configuration
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "5"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+
+
+def search_by_vectors(vector_store, vectors, ks):
+    """Run one FAISS search for several query vectors against a store.
+
+    Returns (document, distance) pairs per query, nearest first.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(matrix)
+    distances, indices = vector_store.index.search(matrix, max(ks))
+    results = []
+    for row_distances, row, k in zip(distances, indices, ks):
+        docs = []
+        for distance, position in zip(row_distances[:k], row[:k]):
+            if position == -1:
+                continue
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+            # Deleted chunks come back as a "not found" string
+            if isinstance(doc, Document):
+                docs.append((doc, float(distance)))
+        results.append(docs)
+    return results
+
+
+def merge_results(results, k):
+    """Nearest k documents across several stores' results.
+
+    Every index type here ranks by L2 distance, so distances from
+    different shards are comparable.
+    """
+    return [doc for doc, _ in heapq.nsmallest(k, chain.from_iterable(results), key=lambda pair: pair[1])]
+
+
+def search_stores(vector_stores, vector, k):
+    """Search one query vector across stores and merge the top k"""
+    return merge_results([search_by_vectors(store, [vector], [k])[0] for store in vector_stores], k)
+
+
+class QueryBatcher:
+    """Merges retrievals that arrive within window_ms of each other.
+
+    Questions in a batch are embedded with one backend request (after the
+    query embedding cache) and searched with one FAISS call per store. A
+    retrieval may fan out over several stores; its results are merged.
+    """
+
+    def __init__(self, window_ms=QUERY_BATCH_WINDOW_MS, max_batch=QUERY_BATCH_MAX_SIZE):
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+        self.batches = 0
+        self.queries = 0
+
+    async def search(self, vector_stores, query, k):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((vector_stores, query, k, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.queries += len(batch)
+        try:
+            vectors = await asyncio.to_thread(get_embeddings().embed_queries, [query for _, query, _, _ in batch])
+
+            # Search each store once for every query that targets it
+            groups = {}
+            for position, ((vector_stores, _, k, _), vector) in enumerate(zip(batch, vectors)):
+                for vector_store in vector_stores:
+                    groups.setdefault(id(vector_store), (vector_store, []))[1].append((position, vector, k))
+            partial = [[] for _ in batch]
+            await asyncio.gather(*(
+                self._search_group(vector_store, group, batch, partial) for vector_store, group in groups.values()
+            ))
+            for (*_, k, future), results in zip(batch, partial):
+                if not future.done():
+                    future.set_result(merge_results(results, k))
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Cancelled before answering: callers must not wait forever
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batched retrieval was cancelled"))
+
+    async def _search_group(self, vector_store, group, batch, partial):
+        try:
+            results = await asyncio.to_thread(
+                search_by_vectors, vector_store, [vector for _, vector, _ in group], [k for _, _, k in group]
+            )
+        except Exception as e:
+            logger.error(f"Batched search failed: {str(e)}")
+            for position, _, _ in group:
+                future = batch[position][3]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (position, _, _), docs in zip(group, results):
+            partial[position].append(docs)
+
+    def stats(self):
+        return {
+            "window_ms": self.window_ms,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "queries": self.queries,
+            "average_batch_size": self.queries / self.batches if self.batches else 0.0,
+        }
+
+
+query_batcher = QueryBatcher()
@@ -2,9 +2,13 @@
 from fastapi import HTTPException, Depends, status, APIRouter
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from models import User, UserBase
-from database import engine, Base, SessionLocal, db_dependency
+from database import engine, Base, SessionLocal, AsyncSessionLocal, db_dependency, async_db_dependency
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
 from typing import Annotated
+import time
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
 from jose import jwt, JWTError
@@ -17,48 +21,101 @@ oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
 load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = os.getenv('ALGORITHM')
+ACCESS_TOKEN_MINUTES = int(os.getenv('ACCESS_TOKEN_MINUTES', '30'))
+REFRESH_TOKEN_DAYS = int(os.getenv('REFRESH_TOKEN_DAYS', '7'))
+# How long a user confirmed to exist is trusted without a database lookup;
+# 0 validates tokens from their claims alone
+AUTH_USER_CACHE_TTL_SECONDS = float(os.getenv('AUTH_USER_CACHE_TTL_SECONDS', '60'))
 
-def authenticate_user(username, password, db:db_dependency):
-    user = db.query(User).filter(User.username == username).first()
+_user_cache = {}  # user id -> (username, checked_at)
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+async def authenticate_user(username, password, db:async_db_dependency):
+    user = await db.scalar(select(User).filter(User.username == username))
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
-    if not bcrypt_context.verify(password ,user.hashed_password):
+    # bcrypt is deliberately slow; keep it off the event loop
+    if not await run_in_threadpool(bcrypt_context.verify, password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
     return user
 
-def create_access_token(user, expires_delta: timedelta):
+def create_access_token(user, expires_delta: timedelta, token_type: str = 'access'):
     encode={'username': user.username, 'id': user.id}
     expire=datetime.now(timezone.utc) + expires_delta
-    return jwt.encode({'exp': expire, 'data': encode}, SECRET_KEY, algorithm=ALGORITHM)
+    return jwt.encode({'exp': expire, 'type': token_type, 'data': encode}, SECRET_KEY, algorithm=ALGORITHM)
+
+def create_token_pair(user):
+    return {
+        "access_token": create_access_token(user, timedelta(minutes=ACCESS_TOKEN_MINUTES)),
+        "refresh_token": create_access_token(user, timedelta(days=REFRESH_TOKEN_DAYS), token_type='refresh'),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_MINUTES * 60,
+    }
+
+def decode_token(token, token_type):
+    """Claims of a valid, unexpired token of the given type"""
+    credentials_error = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload=jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_error
+    # Tokens issued before refresh tokens existed carry no type
+    data = payload.get("data") or {}
+    if payload.get("type", "access") != token_type or data.get('username') is None or data.get('id') is None:
+        raise credentials_error
+    return data
+
+async def user_exists(user_id, username):
+    """Whether the user still exists, remembered for AUTH_USER_CACHE_TTL_SECONDS"""
+    if AUTH_USER_CACHE_TTL_SECONDS <= 0:
+        return True
+    cached = _user_cache.get(user_id)
+    if cached is not None and cached[0] == username and time.monotonic() - cached[1] < AUTH_USER_CACHE_TTL_SECONDS:
+        return True
+    async with AsyncSessionLocal() as db:
+        found = await db.scalar(select(User.username).filter(User.id == user_id))
+    if found != username:
+        _user_cache.pop(user_id, None)
+        return False
+    _user_cache[user_id] = (username, time.monotonic())
+    return True
 
-def get_current_user(db: db_dependency, token: str = Depends(oauth2_bearer)):
-    payload=jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    data = payload.get("data")
-    username: str = data.get('username')
-    user_id: int = data.get('id')
-    if username is None or user_id is None:
+async def get_current_user(token: str = Depends(oauth2_bearer)):
+    data = decode_token(token, 'access')
+    if not await user_exists(data['id'], data['username']):
         raise HTTPException(status_code=401, detail="Could not validate credentials")
-    user = db.query(User).filter(User.username == username).first()
     return {
-        'username': username,
-        'id': user_id,
+        'username': data['username'],
+        'id': data['id'],
     }
 
 @router.post('/register')
-async def register(db:db_dependency, data:UserBase):
+async def register(db:async_db_dependency, data:UserBase):
     data=data.model_dump()
-    data['hashed_password']=bcrypt_context.hash(data['hashed_password'])
+    data['hashed_password']=await run_in_threadpool(bcrypt_context.hash, data['hashed_password'])
     new_user = User(**data)
     db.add(new_user)
-    db.commit()
+    await db.commit()
     return {'message': 'User created'}
 
 @router.post('/token')
-async def login_for_access_token(db:db_dependency, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def login_for_access_token(db:async_db_dependency, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     try:
-        user = authenticate_user(form_data.username, form_data.password, db)
-        token = create_access_token(user, timedelta(minutes=30))
-        return { "access_token": token, "token_type": "bearer" }
+        user = await authenticate_user(form_data.username, form_data.password, db)
+        return create_token_pair(user)
     except HTTPException as e:
         raise e
-    
\ No newline at end of file
+    
+@router.post('/refresh')
+async def refresh_access_token(data: RefreshRequest):
+    claims = decode_token(data.refresh_token, 'refresh')
+    if not await user_exists(claims['id'], claims['username']):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    user = User(id=claims['id'], username=claims['username'])
+    return create_token_pair(user)
@@ -1,24 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException
-import os
+from fastapi import APIRouter, Depends, HTTPException, Query
 import tempfile
-import shutil
+import json
+import time
+import asyncio
 from fastapi import FastAPI, File, UploadFile
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai import AzureOpenAIEmbeddings
+from clients import get_blob_service_client, pool_stats, CONTAINER_NAME
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import delete
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
 from langchain_groq import ChatGroq
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnablePassthrough
+from langchain_core.output_parsers import StrOutputParser
 from routes.auth import get_current_user
-from typing import Annotated
-from pydantic import BaseModel
+from typing import Annotated, Optional, Literal, List
+from pydantic import BaseModel, Field
 import logging
-from database import db_dependency
-from routes.utils import add_conversations, add_chat
-from models import Conversation, message
+from database import db_dependency, async_db_dependency, SessionLocal, engine, async_engine
+from routes.utils import add_turn
+from models import Conversation, message, IngestJob
+from vector_cache import vector_cache
+from vector_store import (
+    get_embeddings, load_document_stores, delete_document_vectors, delete_user_vectors, document_version
+)
+from retrieval import query_batcher
+from context_builder import ContextRetriever
+from ingestion import (
+    IngestQueueFull, enqueue_upload, get_job, job_status, pending_job_for_conversation
+)
+from conversation_memory import HISTORY_MODE, build_memory, history_cache, summarize_history
+from answer_cache import ANSWER_CACHE_ENABLED, answer_cache, answer_cache_document
+from query_modes import QUERY_MODE, QueryUsage, query_mode_stats, retrieval_query
+from metrics import stage, record_usage, StageTimingHandler
+from chat_writer import chat_writer
+from history import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, fetch_page, stream_rows
+from batch_qa import BATCH_MAX_QUESTIONS, BATCH_LLM_CONCURRENCY, answer_batch
+from llm_scheduler import (
+    LLM_DEADLINE_SECONDS, LLM_TIMEOUT_SECONDS, LLMOverloaded, llm_scheduler, until_deadline
+)
 load_dotenv()
 router = APIRouter()
 
@@ -31,127 +52,55 @@ llm = ChatGroq(
     model="llama-3.3-70b-versatile",
     temperature=0.7,
     max_tokens=None,
-    timeout=None,
+    timeout=LLM_TIMEOUT_SECONDS,
     max_retries=2,
 )
 
+# Same model, tagged so streamed answer tokens can be told apart from
+# the condense-question call
+answer_llm = ChatGroq(
+    model="llama-3.3-70b-versatile",
+    temperature=0.7,
+    max_tokens=None,
+    timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=2,
+    tags=["answer"],
+)
+
 # Pydantic models for request/response
 class QueryRequest(BaseModel):
     question: str
     conversation_id: int
+    use_cache: Optional[bool] = None  # defaults to ANSWER_CACHE_ENABLED
+    mode: Optional[Literal["condense", "single"]] = None  # defaults to QUERY_MODE
+    documents: Optional[List[str]] = None  # file names to search; defaults to the conversation's document
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str] = Field(min_length=1, max_length=BATCH_MAX_QUESTIONS)
+    conversation_id: Optional[int] = None
+    documents: Optional[List[str]] = None  # file names to search; defaults to the conversation's document
+    concurrency: Optional[int] = Field(default=None, ge=1)  # capped at BATCH_LLM_CONCURRENCY
 
 class QueryResponse(BaseModel):
     answer: str
     conversation_id: int
     sources: list = []
     conversation_id:int
+    usage: dict = {}
 
 # User dependency
 user_dependency = Annotated[dict, Depends(get_current_user)]
 form_data = Annotated[UploadFile, File(...)]
 
-# Azure configuration
-AZURE_CONNECTION_STRING = os.getenv("AZURE_CONNECTION_STRING")
-CONTAINER_NAME = os.getenv("CONTAINER_NAME")
-
-def get_embeddings():
-    """Get embeddings instance with proper configuration"""
-    return AzureOpenAIEmbeddings(
-        model="text-embedding-3-small",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
-    )
-
-def create_vector_db(documents, username):
-    """Create vector database from documents"""
-    try:
-        # Validate documents
-        if not documents:
-            raise ValueError("No documents were loaded from the PDF")
-        
-        logger.info(f"Processing {len(documents)} documents for user: {username}")
-        
-        # Filter empty documents
-        non_empty_docs = [doc for doc in documents if doc.page_content.strip()]
-        if not non_empty_docs:
-            raise ValueError("All documents are empty")
-        
-        # Chunking
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, 
-            chunk_overlap=200,  # Better overlap for context
-            length_function=len
-        )
-        chunks = text_splitter.split_documents(non_empty_docs)
-        
-        if not chunks:
-            raise ValueError("No chunks were created from documents")
-        
-        logger.info(f"Created {len(chunks)} chunks")
-        
-        # Create embeddings
-        embeddings = get_embeddings()
-        
-        # Create FAISS index
-        faiss_index = FAISS.from_documents(chunks, embedding=embeddings)
-        
-        # Create user directory if it doesn't exist
-        user_dir = f"vector_stores/{username}"
-        os.makedirs(user_dir, exist_ok=True)
-        
-        # Save FAISS index
-        faiss_index.save_local(f"{user_dir}/faiss_index")
-        
-        logger.info(f"Successfully created vector database for user: {username}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error creating vector database: {str(e)}")
-        raise
-
-def load_vector_db(username):
-    """Load existing vector database for a user"""
-    try:
-        user_dir = f"vector_stores/{username}"
-        index_path = f"{user_dir}/faiss_index"
-        
-        if not os.path.exists(index_path):
-            raise FileNotFoundError(f"No vector database found for user: {username}")
-        
-        embeddings = get_embeddings()
-        faiss_index = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
-        
-        return faiss_index
-        
-    except Exception as e:
-        logger.error(f"Error loading vector database: {str(e)}")
-        raise
-
-def create_conversation_chain(vector_store, conversation_id: int, db: db_dependency):
+def create_conversation_chain(vector_stores, conversation_id: int, db: db_dependency, streaming: bool = False):
     """Create conversation chain with memory"""
     try:
         conversation_id=int(conversation_id)
-        data = db.query(message).filter(message.conversation_id == conversation_id).all()
-        
-        memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True,
-            output_key="answer"
-        )
-
-        for msg in data:
-            if msg.sender == "user":
-                memory.chat_memory.add_user_message(msg.content)
-            elif msg.sender == "ai":
-                memory.chat_memory.add_ai_message(msg.content)
-        print(memory.load_memory_variables({}))
+        memory = build_memory(db, conversation_id, llm)
         qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 1}
-            ),
+            llm=answer_llm if streaming else llm,
+            condense_question_llm=llm,
+            retriever=ContextRetriever(vector_stores=vector_stores),
             memory=memory,
             return_source_documents=True,
             verbose=True
@@ -163,6 +112,126 @@ def create_conversation_chain(vector_store, conversation_id: int, db: db_depende
         logger.error(f"Error creating conversation chain: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail="Failed to create conversation chain.")
 
+SINGLE_CALL_SYSTEM_PROMPT = (
+    "Use the following pieces of context and the conversation so far to answer the user's question. "
+    "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
+    "----------------\n{context}"
+)
+
+def create_single_call_chain(vector_stores, conversation_id: int, db: db_dependency, streaming: bool = False):
+    """Answer with one LLM call: retrieve with the raw question, show the model the history"""
+    try:
+        history = build_memory(db, int(conversation_id), llm).chat_memory.messages
+        retriever = ContextRetriever(vector_stores=vector_stores)
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", SINGLE_CALL_SYSTEM_PROMPT),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{question}"),
+        ])
+        answer_chain = (
+            (lambda inputs: {
+                "context": "\n\n".join(doc.page_content for doc in inputs["source_documents"]),
+                "chat_history": history,
+                "question": inputs["question"],
+            })
+            | prompt
+            | (answer_llm if streaming else llm)
+            | StrOutputParser()
+        )
+        return (
+            RunnablePassthrough.assign(
+                source_documents=(lambda inputs: retrieval_query(inputs["question"], history)) | retriever
+            )
+            | RunnablePassthrough.assign(answer=answer_chain)
+        )
+
+    except Exception as e:
+        logger.error(f"Error creating single-call chain: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create conversation chain.")
+
+def create_query_chain(mode, vector_stores, conversation_id: int, db: db_dependency, streaming: bool = False):
+    if mode == "single":
+        return create_single_call_chain(vector_stores, conversation_id, db, streaming=streaming)
+    return create_conversation_chain(vector_stores, conversation_id, db, streaming=streaming)
+
+def load_conversation_stores(db, username, conversation_id, documents=None):
+    """Shards to search for a question: the conversation's document, or the selected ones"""
+    if not documents:
+        conversation = db.get(Conversation, conversation_id)
+        if conversation is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        documents = [conversation.file_name]
+    return load_document_stores(username, documents)
+
+def format_sources(source_documents):
+    return [
+        {
+            "content": doc.page_content[:200] + "...",
+            "metadata": doc.metadata
+        }
+        for doc in source_documents
+    ]
+
+def overloaded(e: LLMOverloaded):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+async def ensure_ready(db, conversation_id, route):
+    """Raise unless the conversation's document has finished ingestion"""
+    with stage(route, "pending_check"):
+        pending = await run_in_threadpool(pending_job_for_conversation, db, conversation_id)
+    if pending is None:
+        return
+    if pending.status == "failed":
+        # Retrying won't help; the document has to be uploaded again
+        raise HTTPException(
+            status_code=422,
+            detail=f"Document could not be processed: {pending.error}"
+        )
+    raise HTTPException(
+        status_code=409,
+        detail=f"Document is not ready for queries (ingestion {pending.status})"
+    )
+
+def query_error(e: Exception, handler: str):
+    """HTTPException to answer a failed query with"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, LLMOverloaded):
+        return overloaded(e)
+    if isinstance(e, TimeoutError):
+        return HTTPException(status_code=504, detail="The model did not answer in time")
+    if isinstance(e, FileNotFoundError):
+        return HTTPException(
+            status_code=404,
+            detail="No documents found. Please upload a PDF file first."
+        )
+    logger.error(f"Error in {handler}: {str(e)}")
+    return HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def lookup_cached_answer(request: QueryRequest, username: str, db):
+    """Return (cached_answer, cache_key, question_vector) for an answer cache lookup.
+
+    cache_key is None when the cache is disabled or bypassed for this request.
+    """
+    use_cache = ANSWER_CACHE_ENABLED if request.use_cache is None else request.use_cache
+    # Answers are cached per document; questions across selected documents bypass it
+    if not use_cache or request.documents:
+        return None, None, None
+    document = await run_in_threadpool(answer_cache_document, db, username, request.conversation_id)
+    if document is None:
+        return None, None, None
+    # Keyed by index version: answers from before another worker rewrote
+    # the document's index are never served
+    version = await run_in_threadpool(document_version, *document)
+    if version is None:
+        return None, None, None
+    cache_key = (*document, version)
+    question_vector = await get_embeddings().aembed_query(request.question)
+    return answer_cache.get(cache_key, question_vector), cache_key, question_vector
+
 
 
 
@@ -171,108 +240,243 @@ def create_conversation_chain(vector_store, conversation_id: int, db: db_depende
 
 
 @router.post('/upload')
-async def upload_file(file: form_data, user: user_dependency, db:db_dependency):
-    """Upload PDF file and create vector database"""
+async def upload_file(file: form_data, user: user_dependency, db:async_db_dependency):
+    """Upload PDF file and queue it for vector database ingestion"""
     try:
         # Validate file type
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
         
-        # Upload to Azure Blob Storage
-        prefix = f"{user['username']}/"
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
-        blob_client = blob_service_client.get_blob_client(
-            container=CONTAINER_NAME, 
-            blob=f"{prefix}{file.filename}"
-        )
-        
-        content = await file.read()
-        blob_client.upload_blob(content, overwrite=True)
-        
-        # Download and process PDF
-        pdf_bytes = blob_client.download_blob().readall()
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(pdf_bytes)
-            tmp_path = tmp.name
-        
-        # Load PDF documents
-        loader = PyPDFLoader(file_path=tmp_path)
-        documents = loader.load()
-        # db.add()
-        # Clean up temporary file
-        os.remove(tmp_path)
-        
-        # Create vector database
-        create_vector_db(documents, user['username'])
-        conversation_id=add_conversations(db,user['id'],file.filename,f'analysis_{file.filename}')
+        # Stream to blob storage and the spool file; parsing and embedding
+        # run in the ingestion worker pool
+        job_id, conversation_id = await enqueue_upload(db, user, file)
 
         return {
-            "message": f"Successfully uploaded and processed {file.filename}",
-            "document_count": len(documents),
-            "status": "ready_for_queries",
+            "message": f"Uploaded {file.filename}, processing has started",
+            "job_id": job_id,
+            "status": "queued",
             "conversation_id" :  conversation_id
         }
         
+    except HTTPException:
+        raise
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Error in upload_file: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get('/upload/{job_id}')
+async def upload_status(job_id: str, user: user_dependency, db:async_db_dependency):
+    """Report the progress of an ingestion job"""
+    job = await get_job(db, job_id)
+    if job is None or job.user_id != user['id']:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return job_status(job)
+
 @router.post('/query', response_model=QueryResponse)
 async def query_documents(request: QueryRequest, user: user_dependency, db:db_dependency):
     """Query the vector database"""
     try:
-        # Load user's vector database
-        vector_store = load_vector_db(user['username'])
-        
-        # Create conversation chain
-        qa_chain = create_conversation_chain(vector_store, request.conversation_id, db)
-        
-        # Query the chain
-        result = qa_chain.invoke({"question": request.question})
-        
-        # Extract sources
-        sources = []
-        if 'source_documents' in result:
-            sources = [
-                {
-                    "content": doc.page_content[:200] + "...",
-                    "metadata": doc.metadata
-                } 
-                for doc in result['source_documents']
-            ]
+        # Conversations only become queryable once their index is ready
+        await ensure_ready(db, request.conversation_id, "query")
+
+        mode = request.mode or QUERY_MODE
+        started = time.perf_counter()
+        usage = QueryUsage()
+
+        # Repeated first-turn questions about the same document can skip the LLM
+        with stage("query", "answer_cache"):
+            cached, cache_key, question_vector = await lookup_cached_answer(request, user['username'], db)
+        if cached is not None:
+            result = {'answer': cached['answer']}
+            sources = cached['sources']
+            report = usage.report("cache", time.perf_counter() - started)
+        else:
+            # Load user's vector database
+            with stage("query", "load_index"):
+                vector_stores = await run_in_threadpool(
+                    load_conversation_stores, db, user['username'], request.conversation_id, request.documents
+                )
+            
+            # Build and query the chain once the scheduler admits it;
+            # retrieval runs FAISS search in an executor
+            async with llm_scheduler.slot(user['username']):
+                async with asyncio.timeout(LLM_DEADLINE_SECONDS):
+                    await summarize_history(db, request.conversation_id, llm, config={"callbacks": [usage]})
+                    with stage("query", "build_chain"):
+                        qa_chain = await run_in_threadpool(
+                            create_query_chain, mode, vector_stores, request.conversation_id, db
+                        )
+                    result = await qa_chain.ainvoke(
+                        {"question": request.question}, config={"callbacks": [usage, StageTimingHandler("query")]}
+                    )
+            report = usage.report(mode, time.perf_counter() - started)
+            query_mode_stats.record(report)
+            record_usage(report)
+            
+            # Extract sources
+            sources = []
+            if 'source_documents' in result:
+                sources = format_sources(result['source_documents'])
+            if cache_key is not None:
+                answer_cache.put(cache_key, question_vector, result['answer'], sources)
         request.conversation_id
         question = request.question
         answer = result['answer']
 
-        add_chat(db, conversation_id=request.conversation_id, content=question, sender='user')
-        add_chat(db, conversation_id=request.conversation_id, content=answer, sender='ai')
+        with stage("query", "persist"):
+            await run_in_threadpool(add_turn, db, request.conversation_id, question, answer)
         return QueryResponse(
             answer=result['answer'],
             conversation_id=request.conversation_id or "default",
-            sources=sources
-            
+            sources=sources,
+            usage=report
         )
         
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=404, 
-            detail="No documents found. Please upload a PDF file first."
-        )
     except Exception as e:
-        logger.error(f"Error in query_documents: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise query_error(e, "query_documents")
+
+@router.post('/query/stream')
+async def query_documents_stream(request: QueryRequest, user: user_dependency, db:db_dependency):
+    """Query the vector database, streaming answer tokens as Server-Sent Events"""
+    try:
+        await ensure_ready(db, request.conversation_id, "query_stream")
+        mode = request.mode or QUERY_MODE
+        started = time.perf_counter()
+        usage = QueryUsage()
+        with stage("query_stream", "answer_cache"):
+            cached, cache_key, question_vector = await lookup_cached_answer(request, user['username'], db)
+        if cached is None:
+            # Turn the request away now rather than after the stream has started
+            llm_scheduler.check_admission(user['username'])
+            with stage("query_stream", "load_index"):
+                vector_stores = await run_in_threadpool(
+                    load_conversation_stores, db, user['username'], request.conversation_id, request.documents
+                )
+            if HISTORY_MODE == "summary":
+                # Folding old turns calls the model before the stream starts
+                async with llm_scheduler.slot(user['username']):
+                    async with asyncio.timeout(LLM_DEADLINE_SECONDS):
+                        await summarize_history(db, request.conversation_id, llm, config={"callbacks": [usage]})
+            with stage("query_stream", "build_chain"):
+                qa_chain = await run_in_threadpool(
+                    create_query_chain, mode, vector_stores, request.conversation_id, db, streaming=True
+                )
+    except Exception as e:
+        raise query_error(e, "query_documents_stream")
+
+    async def event_stream():
+        tokens = []
+        result = None
+        try:
+            if cached is not None:
+                answer = cached['answer']
+                sources = cached['sources']
+                report = usage.report("cache", time.perf_counter() - started)
+                yield sse_event("token", {"token": answer})
+            else:
+                async with llm_scheduler.slot(user['username']):
+                    async for event in until_deadline(qa_chain.astream_events(
+                        {"question": request.question},
+                        config={"callbacks": [usage, StageTimingHandler("query_stream")]},
+                        version="v2"
+                    )):
+                        if event["event"] == "on_chat_model_stream" and "answer" in event["tags"]:
+                            token = event["data"]["chunk"].content
+                            if token:
+                                tokens.append(token)
+                                yield sse_event("token", {"token": token})
+                        elif event["event"] == "on_chain_end" and not event["parent_ids"]:
+                            result = event["data"]["output"]
+
+                answer = result['answer'] if result else "".join(tokens)
+                sources = format_sources(result.get('source_documents', [])) if result else []
+                report = usage.report(mode, time.perf_counter() - started)
+                query_mode_stats.record(report)
+                record_usage(report)
+                if cache_key is not None:
+                    answer_cache.put(cache_key, question_vector, answer, sources)
+            yield sse_event("sources", {"sources": sources})
+
+            # The request's session is closed once streaming starts; use a fresh one
+            def persist_turn():
+                with SessionLocal() as write_db:
+                    add_turn(write_db, request.conversation_id, request.question, answer)
+            with stage("query_stream", "persist"):
+                await run_in_threadpool(persist_turn)
+            yield sse_event("done", {"conversation_id": request.conversation_id, "answer": answer, "usage": report})
+        except LLMOverloaded as e:
+            yield sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+        except TimeoutError:
+            yield sse_event("error", {"detail": "The model did not answer in time"})
+        except Exception as e:
+            logger.error(f"Error streaming query: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post('/query/batch')
+async def query_documents_batch(request: BatchQueryRequest, user: user_dependency, db:db_dependency):
+    """Answer many independent questions about one document, streaming NDJSON results as they finish.
+
+    The index is loaded once and the questions are embedded and searched
+    together; answers are not added to the conversation's history.
+    """
+    try:
+        if request.conversation_id is None and not request.documents:
+            raise HTTPException(status_code=400, detail="Either conversation_id or documents is required")
+        if request.conversation_id is not None:
+            await ensure_ready(db, request.conversation_id, "batch_query")
+        llm_scheduler.check_admission(user['username'])
+        with stage("batch_query", "load_index"):
+            vector_stores = await run_in_threadpool(
+                load_conversation_stores, db, user['username'], request.conversation_id, request.documents
+            )
+    except Exception as e:
+        raise query_error(e, "query_documents_batch")
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SINGLE_CALL_SYSTEM_PROMPT),
+        ("human", "{question}"),
+    ])
+    concurrency = min(request.concurrency or BATCH_LLM_CONCURRENCY, BATCH_LLM_CONCURRENCY)
+
+    async def lines():
+        try:
+            async for index, result in answer_batch(
+                llm, prompt, vector_stores, request.questions, user['username'], concurrency
+            ):
+                line = {"index": index, "question": request.questions[index]}
+                if "error" in result:
+                    line["error"] = result["error"]
+                else:
+                    query_mode_stats.record(result["usage"])
+                    record_usage(result["usage"])
+                    line.update(
+                        answer=result["answer"],
+                        sources=format_sources(result["source_documents"]),
+                        usage=result["usage"],
+                    )
+                yield json.dumps(line, default=str) + "\n"
+        except Exception as e:
+            logger.error(f"Error in batch query: {str(e)}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @router.get('/documents')
 async def list_user_documents(user: user_dependency):
     """List all documents uploaded by the user"""
     try:
         prefix = f"{user['username']}/"
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
-        container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-        
         documents = []
-        for blob in container_client.list_blobs(name_starts_with=prefix):
+        container_client = get_blob_service_client().get_container_client(CONTAINER_NAME)
+        async for blob in container_client.list_blobs(name_starts_with=prefix):
             documents.append({
                 "filename": blob.name.replace(prefix, ""),
                 "size": blob.size,
@@ -290,15 +494,14 @@ async def delete_document(filename: str, user: user_dependency):
     """Delete a specific document"""
     try:
         prefix = f"{user['username']}/"
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
-        blob_client = blob_service_client.get_blob_client(
+        blob_client = get_blob_service_client().get_blob_client(
             container=CONTAINER_NAME,
             blob=f"{prefix}{filename}"
         )
+        await blob_client.delete_blob()
+        removed_chunks = await run_in_threadpool(delete_document_vectors, user['username'], filename)
         
-        blob_client.delete_blob()
-        
-        return {"message": f"Successfully deleted {filename}"}
+        return {"message": f"Successfully deleted {filename}", "removed_chunks": removed_chunks}
         
     except Exception as e:
         logger.error(f"Error deleting document: {str(e)}")
@@ -309,38 +512,79 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "RAG API"}
 
+@router.get('/cacheStats')
+async def cache_stats(user: user_dependency):
+    """Hit/miss counters and memory usage of the vector store cache"""
+    return {
+        "vector_stores": vector_cache.stats(),
+        "answers": answer_cache.stats(),
+        "query_embeddings": get_embeddings().query_cache_stats(),
+        "query_batches": query_batcher.stats(),
+        "chat_writes": chat_writer.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+    }
+
+@router.get('/queryStats')
+async def query_stats(user: user_dependency):
+    """Average latency, LLM calls and tokens per query mode"""
+    return query_mode_stats.stats()
+
+@router.get('/poolStats')
+async def connection_pool_stats(user: user_dependency):
+    """Connection pool usage of the database engines"""
+    return {
+        "database": pool_stats(engine.pool),
+        "async_database": pool_stats(async_engine.pool),
+    }
+
 @router.delete('/deleteVectorDB')
 async def delete_vector(user: user_dependency):
     try:
         username = user['username']
-        user_dir = f"vector_stores/{username}"
 
-        if os.path.exists(user_dir):
-            shutil.rmtree(user_dir)
+        if await run_in_threadpool(delete_user_vectors, username):
             return {"message": f"Vector store for user '{username}' deleted successfully."}
         else:
             raise HTTPException(status_code=404, detail="Vector store not found.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error deleting vector store: {str(e)}")
         raise HTTPException(status_code=500, detail="Error deleting vector store.")
 
+page_size = Annotated[int, Query(ge=1, le=HISTORY_MAX_PAGE_SIZE)]
+
+async def list_history(db, model, condition, limit, cursor, stream):
+    """A page of rows with the next page's cursor, or every row as NDJSON"""
+    if stream:
+        lines = await stream_rows(model, condition, limit, cursor)
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+    data, next_cursor = await fetch_page(db, model, condition, limit, cursor)
+    return {'data': data, 'next_cursor': next_cursor}
+
 @router.get('/getConversations')
-def get_conversations(user:user_dependency, db:db_dependency):
+async def get_conversations(user:user_dependency, db:async_db_dependency, limit: page_size = HISTORY_PAGE_SIZE,
+                            cursor: Optional[str] = None, stream: bool = False):
     try:
         userId = user['id']
-        data = db.query(Conversation).filter(Conversation.user_id==userId).all()
-        return {'data':data}
+        return await list_history(db, Conversation, Conversation.user_id==userId, limit, cursor, stream)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting conversations: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error getting conversations")
 
 @router.get('/getMessages')
-def get_conversations(conId:int, db:db_dependency):
+async def get_messages(conId:int, db:async_db_dependency, limit: page_size = HISTORY_PAGE_SIZE,
+                       cursor: Optional[str] = None, stream: bool = False):
     try:
-        conId = int(conId)
-        data = db.query(message).filter(message.conversation_id==conId).all()
-        return {'data':data}
+        await run_in_threadpool(chat_writer.wait_for, conId)
+        return await list_history(db, message, message.conversation_id==conId, limit, cursor, stream)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error getting conversations: {str(e)}")
+        logger.error(f"Error getting messages: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error getting messages")
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
@@ -348,24 +592,27 @@ from models import Conversation, message  # Assuming correct import
 from database import get_db  # Your db dependency
 
 @router.delete('/deleteConversation')
-async def delete_conversation(conId: int, db: Session = Depends(get_db)):
+async def delete_conversation(conId: int, db: async_db_dependency):
     try:
         # Step 1: Check if conversation exists
-        conversation = db.query(Conversation).filter(Conversation.id == conId).first()
+        conversation = await db.get(Conversation, conId)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
 
-        # Step 2: Delete all related messages
-        db.query(message).filter(message.conversation_id == conId).delete()
+        # Step 2: Delete all related messages, including any still queued
+        await run_in_threadpool(chat_writer.wait_for, conId)
+        await db.execute(delete(message).where(message.conversation_id == conId))
+        await db.execute(delete(IngestJob).where(IngestJob.conversation_id == conId))
 
         # Step 3: Delete the conversation
-        db.delete(conversation)
+        await db.delete(conversation)
 
         # Step 4: Commit
-        db.commit()
+        await db.commit()
+        history_cache.invalidate(conId)
 
         return {"success": True, "message": "Conversation and related messages deleted successfully"}
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return {"success": False, "message": f"Error deleting conversation: {str(e)}"}
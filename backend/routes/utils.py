@@ -1,5 +1,8 @@
 from database import db_dependency
-from models import Conversation, message
+from models import Conversation
+from conversation_memory import history_cache
+from chat_writer import chat_writer, write_messages
+from datetime import datetime, timezone
 def add_conversations(db, userId:int,filename, title):
     data = {}
     data['user_id'] = userId
@@ -11,12 +14,13 @@ def add_conversations(db, userId:int,filename, title):
     db.refresh(data)
     return data.id
 
-def add_chat(db,conversation_id,content,sender):
-    data = {}
-    data['conversation_id'] = conversation_id
-    data['content'] = content
-    data['sender'] = sender
-    data=message(**data)
-    db.add(data)
-    db.commit()
-    db.refresh(data)
\ No newline at end of file
+def add_turn(db, conversation_id, question, answer):
+    """Save a question and its answer; queued when write-behind is running"""
+    rows = [('user', question), ('ai', answer)]
+    if chat_writer.running:
+        chat_writer.submit(conversation_id, rows)
+    else:
+        write_messages(db, [(conversation_id, datetime.now(timezone.utc), rows)])
+    # Memory sees the turn right away, whether or not it is written yet
+    history_cache.append(conversation_id, 'user', question)
+    history_cache.append(conversation_id, 'ai', answer)
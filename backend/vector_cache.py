@@ -0,0 +1,118 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from docstore import DOCSTORE_FILE
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+VECTOR_CACHE_MAX_BYTES = int(os.getenv("VECTOR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+VECTOR_CACHE_TTL_SECONDS = float(os.getenv("VECTOR_CACHE_TTL_SECONDS", "900"))
+
+
+def index_size_on_disk(index_path):
+    """Approximate the resident size of a saved index from its files.
+
+    The docstore is read lazily from disk, so it is not counted.
+    """
+    total = 0
+    for name in os.listdir(index_path):
+        if name == DOCSTORE_FILE:
+            continue
+        total += os.path.getsize(os.path.join(index_path, name))
+    return total
+
+
+class VectorStoreCache:
+    """Process-wide LRU cache of loaded vector stores.
+
+    Keys are a username for a user's combined index or (username, path)
+    for a document shard.
+
+    Entries are evicted least-recently-used first once the memory budget is
+    exceeded, and are dropped on access once they are older than the TTL.
+    """
+
+    def __init__(self, max_bytes=VECTOR_CACHE_MAX_BYTES, ttl_seconds=VECTOR_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expired = self.ttl_seconds and time.monotonic() - entry["loaded_at"] > self.ttl_seconds
+            if expired or (version is not None and entry["version"] != version):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value, size, version=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                logger.info(f"Not caching {key}: {size} bytes exceeds cache budget")
+                return
+            self._entries[key] = {
+                "value": value,
+                "size": size,
+                "version": version,
+                "loaded_at": time.monotonic(),
+            }
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_user(self, username):
+        """Drop a user's combined index and all of their document shards"""
+        with self._lock:
+            for key in list(self._entries):
+                if key == username or (isinstance(key, tuple) and key[0] == username):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+
+
+vector_cache = VectorStoreCache()
@@ -0,0 +1,534 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from langchain_openai import AzureOpenAIEmbeddings
+from vector_cache import vector_cache, index_size_on_disk
+from index_versions import current_version, index_exists, new_version_dir, publish_version, remove_index
+from docstore import DOCSTORE_FILE, SQLiteDocstore, write_docstore
+from embedding_cache import CachedEmbeddings, FakeEmbeddings, embedding_store
+from clients import get_http_client, get_http_async_client
+from answer_cache import answer_cache
+from index_types import (
+    CONFIG_FILE, choose_index_config, build_index, apply_search_params, supports_remove,
+    load_index_config, save_index_config
+)
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+import numpy as np
+import faiss
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialised within a process
+    fcntl = None
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "azure")  # azure | fake
+
+INDEX_FILE = "index.faiss"
+LEGACY_DOCSTORE_FILE = "index.pkl"
+
+# Serialises writers (ingest, delete, compaction) of each user's index:
+# a thread lock within the process, a file lock across worker processes.
+# Lock files live outside the user's directory, which deletion removes.
+_index_locks = defaultdict(threading.Lock)
+LOCK_DIR = "vector_stores/.locks"
+
+
+@contextmanager
+def user_index_lock(username, blocking=True):
+    """Hold the writer lock of a user's indexes.
+
+    Yields True once held. With blocking=False, yields False straight away
+    when another thread or worker holds it.
+    """
+    lock = _index_locks[username]
+    if not lock.acquire(blocking):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        with open(os.path.join(LOCK_DIR, f"{username}.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        lock.release()
+
+
+def index_dir(username):
+    """The user's combined index, written before documents had their own shards"""
+    return f"vector_stores/{username}/faiss_index"
+
+
+def shard_dir(username, file_name):
+    """Index holding the chunks of one of the user's documents"""
+    shard_id = hashlib.sha1(file_name.encode("utf-8")).hexdigest()[:20]
+    return f"vector_stores/{username}/documents/{shard_id}"
+
+
+def load_manifest(index_path):
+    """Chunk ids per document plus ids deleted but not yet compacted away"""
+    path = os.path.join(index_path, "manifest.json")
+    if not os.path.exists(path):
+        return {"documents": {}, "tombstones": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _present_ids(faiss_index, ids):
+    present = set(faiss_index.index_to_docstore_id.values())
+    return [chunk_id for chunk_id in ids if chunk_id in present]
+
+
+def _manifest_mtime(index_path):
+    try:
+        return os.path.getmtime(os.path.join(index_path, "manifest.json"))
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(index_path, manifest):
+    path = os.path.join(index_path, "manifest.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def save_vector_store(faiss_index, index_path, config):
+    """Write the FAISS index, its SQLite docstore and config as a new version and switch to it"""
+    version, directory = new_version_dir(index_path)
+    faiss.write_index(faiss_index.index, os.path.join(directory, INDEX_FILE))
+    write_docstore(
+        os.path.join(directory, DOCSTORE_FILE), faiss_index.docstore, faiss_index.index_to_docstore_id
+    )
+    save_index_config(directory, config)
+    publish_version(index_path, version)
+    # Files of an index saved before versioning are superseded now
+    for name in (INDEX_FILE, DOCSTORE_FILE, LEGACY_DOCSTORE_FILE, CONFIG_FILE):
+        legacy_path = os.path.join(index_path, name)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+
+def index_config(index_path):
+    """Settings the live version of an index was built with"""
+    return load_index_config(current_version(index_path)[1])
+
+
+def _migrate_legacy_index(index_path, embeddings):
+    """Convert an index saved with a pickled index.pkl docstore, once.
+
+    The caller holds the user's index lock.
+    """
+    if os.path.exists(os.path.join(index_path, DOCSTORE_FILE)):
+        return
+    if not os.path.exists(os.path.join(index_path, LEGACY_DOCSTORE_FILE)):
+        return
+    logger.info(f"Migrating pickled docstore at {index_path}")
+    faiss_index = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+    save_vector_store(faiss_index, index_path, load_index_config(index_path))
+
+
+def open_vector_store(index_path, embeddings, writable=False, mapped=True):
+    """Open the live version of a saved index.
+
+    Readers map the index file read-only, so every worker process shares
+    one copy in the page cache, and get a docstore that fetches chunks from
+    disk on demand. Writers, and readers that must drop vectors in memory
+    (mapped=False), get a private copy of the index.
+    """
+    _migrate_legacy_index(index_path, embeddings)
+    _, directory = current_version(index_path)
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mapped and not writable else 0
+    index = faiss.read_index(os.path.join(directory, INDEX_FILE), flags)
+    docstore = SQLiteDocstore(os.path.join(directory, DOCSTORE_FILE))
+    if writable:
+        in_memory, index_to_docstore_id = docstore.load_all()
+        return FAISS(embeddings, index, in_memory, index_to_docstore_id)
+    return FAISS(embeddings, index, docstore, docstore.position_map())
+
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings():
+    """Shared embeddings instance, created once per process"""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            if EMBEDDING_BACKEND == "fake":
+                underlying = FakeEmbeddings()
+            else:
+                underlying = AzureOpenAIEmbeddings(
+                    model=EMBEDDING_MODEL,
+                    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                    api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+                    http_client=get_http_client(),
+                    http_async_client=get_http_async_client()
+                )
+            _embeddings = CachedEmbeddings(underlying, EMBEDDING_MODEL, embedding_store)
+        return _embeddings
+
+def _new_vector_store(embeddings, config, text_embeddings, metadatas, ids, dimension=None):
+    """FAISS store of the configured index type holding the given vectors"""
+    vectors = np.asarray([vector for _, vector in text_embeddings], dtype=np.float32)
+    if dimension is None:
+        dimension = vectors.shape[1]
+    index = build_index(dimension, config, training_vectors=vectors)
+    faiss_index = FAISS(embeddings, index, InMemoryDocstore(), {})
+    if text_embeddings:
+        faiss_index.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+    return faiss_index
+
+def _rebuild_vector_store(faiss_index, exclude_ids, config, embeddings,
+                          text_embeddings=(), metadatas=(), ids=()):
+    """Rebuild a store as a new index type, dropping exclude_ids.
+
+    Stored chunk vectors come back from the embedding cache, so a rebuild
+    costs index construction rather than embedding calls.
+    """
+    exclude_ids = set(exclude_ids)
+    kept_ids = [
+        chunk_id for _, chunk_id in sorted(faiss_index.index_to_docstore_id.items())
+        if chunk_id not in exclude_ids
+    ]
+    kept_docs = [faiss_index.docstore.search(chunk_id) for chunk_id in kept_ids]
+    kept_vectors = embeddings.embed_documents([doc.page_content for doc in kept_docs])
+    all_text_embeddings = list(zip([doc.page_content for doc in kept_docs], kept_vectors)) + list(text_embeddings)
+    all_metadatas = [doc.metadata for doc in kept_docs] + list(metadatas)
+    all_ids = kept_ids + list(ids)
+    logger.info(f"Rebuilding index as {config['index_type']} with {len(all_ids)} chunks")
+    return _new_vector_store(
+        embeddings, config, all_text_embeddings, all_metadatas, all_ids, dimension=faiss_index.index.d
+    )
+
+def split_documents(documents, file_name=None):
+    """Split pages into overlapping chunks tagged with their source file"""
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, 
+        chunk_overlap=200,  # Better overlap for context
+        length_function=len,
+        add_start_index=True,  # lets the context builder merge overlapping hits
+    )
+    chunks = text_splitter.split_documents(documents)
+    for chunk in chunks:
+        chunk.metadata["file_name"] = file_name
+    return chunks
+
+def create_vector_db(documents, username, on_progress=None, file_name=None):
+    """Add documents to the user's vector database, creating it if needed.
+
+    Only the new chunks are embedded; they are appended to the existing
+    index. Re-adding a file_name replaces that document's earlier chunks.
+    on_progress, if given, is called with keyword counts as chunks are
+    embedded and once the index is saved.
+    """
+    try:
+        # Validate documents
+        if not documents:
+            raise ValueError("No documents were loaded from the PDF")
+        
+        logger.info(f"Processing {len(documents)} documents for user: {username}")
+        
+        # Filter empty documents
+        non_empty_docs = [doc for doc in documents if doc.page_content.strip()]
+        if not non_empty_docs:
+            raise ValueError("All documents are empty")
+        
+        # Chunking
+        chunks = split_documents(non_empty_docs, file_name)
+        
+        if not chunks:
+            raise ValueError("No chunks were created from documents")
+        
+        logger.info(f"Created {len(chunks)} chunks")
+        if on_progress:
+            on_progress(chunks_total=len(chunks), chunks_embedded=0)
+        
+        # Create embeddings
+        embeddings = get_embeddings()
+        
+        texts = [chunk.page_content for chunk in chunks]
+        vectors = embeddings.embed_documents(
+            texts,
+            on_progress=(lambda done: on_progress(chunks_embedded=done)) if on_progress else None
+        )
+        
+        add_embedded_chunks(username, file_name, list(zip(texts, vectors)), [chunk.metadata for chunk in chunks])
+        if on_progress:
+            on_progress(index_saved=True)
+        
+        logger.info(f"Successfully created vector database for user: {username}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error creating vector database: {str(e)}")
+        raise
+
+def add_embedded_chunks(username, file_name, text_embeddings, metadatas):
+    """Write already embedded chunks of one file as that document's shard"""
+    with user_index_lock(username):
+        _write_shard(username, file_name, text_embeddings, metadatas)
+        # A re-upload supersedes whatever the combined index held for the file
+        _retire_from_user_index(username, file_name)
+        answer_cache.invalidate_user(username)
+
+def _write_shard(username, file_name, text_embeddings, metadatas, ids=None):
+    """Build a document's shard, replacing any earlier one. The caller holds the user's lock."""
+    embeddings = get_embeddings()
+    if ids is None:
+        ids = [str(uuid.uuid4()) for _ in text_embeddings]
+    path = shard_dir(username, file_name)
+    config = choose_index_config(len(ids), username)
+    faiss_index = _new_vector_store(embeddings, config, text_embeddings, metadatas, ids)
+    save_vector_store(faiss_index, path, config)
+    vector_cache.invalidate((username, path))
+
+def _retire_from_user_index(username, file_name):
+    """Tombstone a document in the combined index. The caller holds the user's lock.
+
+    Returns the number of chunks retired. The combined index is removed
+    once no documents are left in it.
+    """
+    index_path = index_dir(username)
+    if not index_exists(index_path):
+        return 0
+    manifest = load_manifest(index_path)
+    ids = manifest["documents"].pop(file_name, [])
+    if not ids:
+        return 0
+    if manifest["documents"]:
+        manifest["tombstones"].extend(ids)
+        save_manifest(index_path, manifest)
+    else:
+        remove_index(index_path)
+    vector_cache.invalidate(username)
+    return len(ids)
+
+def _needs_split(username, file_name):
+    """Whether a document is still only in the combined index"""
+    if index_exists(shard_dir(username, file_name)):
+        return False
+    index_path = index_dir(username)
+    return index_exists(index_path) and bool(load_manifest(index_path)["documents"].get(file_name))
+
+def _split_from_user_index(username, file_name):
+    """Move a document from the combined index into its own shard, once.
+
+    Stored chunk vectors come back from the embedding cache. Returns False
+    when the combined index does not list the document.
+    """
+    # Runs on every query: only take the writer lock, which an ingest or
+    # compaction may hold for a whole index build, when there is a split to do
+    if not _needs_split(username, file_name):
+        return index_exists(shard_dir(username, file_name))
+    with user_index_lock(username):
+        if not _needs_split(username, file_name):
+            return index_exists(shard_dir(username, file_name))
+        index_path = index_dir(username)
+        ids = load_manifest(index_path)["documents"][file_name]
+        embeddings = get_embeddings()
+        faiss_index = open_vector_store(index_path, embeddings)
+        found = [(chunk_id, faiss_index.docstore.search(chunk_id)) for chunk_id in ids]
+        found = [(chunk_id, doc) for chunk_id, doc in found if isinstance(doc, Document)]
+        if not found:
+            return False
+        texts = [doc.page_content for _, doc in found]
+        vectors = embeddings.embed_documents(texts)
+        logger.info(f"Moving {len(found)} chunks of {file_name} into a shard for user: {username}")
+        _write_shard(
+            username, file_name, list(zip(texts, vectors)),
+            [doc.metadata for _, doc in found], [chunk_id for chunk_id, _ in found]
+        )
+        _retire_from_user_index(username, file_name)
+        return True
+
+def document_version(username, file_name):
+    """Version id of the index serving a document, or None when it has none.
+
+    The id changes whenever any worker replaces the index, so caches keyed
+    by it never serve results from an older copy.
+    """
+    for path in (shard_dir(username, file_name), index_dir(username)):
+        try:
+            return current_version(path)[0]
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def load_document_store(username, file_name):
+    """Load one document's shard, reusing the cached copy unless it changed on disk"""
+    path = shard_dir(username, file_name)
+    if not index_exists(path):
+        raise FileNotFoundError(f"No vectors found for document: {file_name}")
+    # The version pointer tells every worker when the shard was replaced
+    version, directory = current_version(path)
+    faiss_index = vector_cache.get((username, path), version)
+    if faiss_index is not None:
+        return faiss_index
+    faiss_index = open_vector_store(path, get_embeddings())
+    apply_search_params(faiss_index.index, load_index_config(directory))
+    vector_cache.put((username, path), faiss_index, index_size_on_disk(directory), version)
+    return faiss_index
+
+def load_document_stores(username, file_names):
+    """Vector stores to search for a set of the user's documents, one per shard.
+
+    Documents still in the combined index are split into shards on first
+    use. Ones it cannot attribute (indexes older than its manifest) are
+    served from the combined index as a whole. Missing documents are
+    skipped; FileNotFoundError is raised when none are found.
+    """
+    stores = []
+    use_user_index = False
+    for file_name in dict.fromkeys(file_names):
+        try:
+            if _split_from_user_index(username, file_name):
+                stores.append(load_document_store(username, file_name))
+            else:
+                use_user_index = True
+        except FileNotFoundError:
+            # Deleted while we looked
+            continue
+    if use_user_index:
+        try:
+            stores.append(load_vector_db(username))
+        except FileNotFoundError:
+            pass
+    if not stores:
+        raise FileNotFoundError(f"No vector database found for user: {username}")
+    return stores
+
+def load_vector_db(username):
+    """Load existing vector database for a user"""
+    try:
+        index_path = index_dir(username)
+        
+        if not index_exists(index_path):
+            vector_cache.invalidate(username)
+            raise FileNotFoundError(f"No vector database found for user: {username}")
+        
+        embeddings = get_embeddings()
+        if os.path.exists(os.path.join(index_path, LEGACY_DOCSTORE_FILE)):
+            with user_index_lock(username):
+                _migrate_legacy_index(index_path, embeddings)
+        
+        # Reuse the loaded index unless another writer, in any worker,
+        # published a new version or tombstoned documents since
+        version, directory = current_version(index_path)
+        version = (version, _manifest_mtime(index_path))
+        faiss_index = vector_cache.get(username, version)
+        if faiss_index is not None:
+            return faiss_index
+        
+        # Drop deleted documents from a private copy until compaction; a
+        # mapped index is read-only
+        tombstones = load_manifest(index_path)["tombstones"]
+        faiss_index = open_vector_store(index_path, embeddings, mapped=not tombstones)
+        config = load_index_config(directory)
+        apply_search_params(faiss_index.index, config)
+        if tombstones and supports_remove(config):
+            tombstones = _present_ids(faiss_index, tombstones)
+            if tombstones:
+                faiss_index.delete(tombstones)
+        vector_cache.put(username, faiss_index, index_size_on_disk(directory), version)
+        
+        return faiss_index
+        
+    except Exception as e:
+        logger.error(f"Error loading vector database: {str(e)}")
+        raise
+
+def delete_document_vectors(username, file_name):
+    """Remove a document's shard, or mark its chunks deleted in the combined index"""
+    removed = 0
+    path = shard_dir(username, file_name)
+    with user_index_lock(username):
+        if index_exists(path):
+            removed = index_config(path).get("num_vectors", 0)
+        if remove_index(path):
+            vector_cache.invalidate((username, path))
+        removed += _retire_from_user_index(username, file_name)
+        if removed:
+            answer_cache.invalidate_user(username)
+    # Indexes that cannot drop vectors in place are rebuilt straight away
+    index_path = index_dir(username)
+    if index_exists(index_path) and not supports_remove(index_config(index_path)):
+        compact_vector_db(username)
+    return removed
+
+def delete_user_vectors(username):
+    """Remove all of a user's indexes; returns False when there were none"""
+    with user_index_lock(username):
+        removed = remove_index(f"vector_stores/{username}")
+    vector_cache.invalidate_user(username)
+    answer_cache.invalidate_user(username)
+    return removed
+
+def compact_vector_db(username, blocking=True):
+    """Physically remove tombstoned chunks from a user's saved index.
+
+    With blocking=False, a user whose index another writer (in any worker)
+    holds is skipped until the next round.
+    """
+    index_path = index_dir(username)
+    with user_index_lock(username, blocking) as locked:
+        if not locked:
+            return 0
+        if not index_exists(index_path):
+            return 0
+        manifest = load_manifest(index_path)
+        if not manifest["tombstones"]:
+            return 0
+        embeddings = get_embeddings()
+        faiss_index = open_vector_store(index_path, embeddings, writable=True)
+        removed = _present_ids(faiss_index, manifest["tombstones"])
+        if removed:
+            current = index_config(index_path)
+            config = choose_index_config(faiss_index.index.ntotal - len(removed), username)
+            if config["index_type"] != current["index_type"] or not supports_remove(current):
+                faiss_index = _rebuild_vector_store(faiss_index, removed, config, embeddings)
+            else:
+                faiss_index.delete(removed)
+                config = dict(current, num_vectors=faiss_index.index.ntotal)
+            save_vector_store(faiss_index, index_path, config)
+        manifest["tombstones"] = []
+        save_manifest(index_path, manifest)
+        vector_cache.invalidate(username)
+    logger.info(f"Compacted vector database for user: {username}, removed {len(removed)} chunks")
+    return len(removed)
+
+def compact_all_vector_dbs():
+    if not os.path.isdir("vector_stores"):
+        return
+    for username in os.listdir("vector_stores"):
+        if os.path.isdir(index_dir(username)):
+            try:
+                # Every worker runs this on the same schedule; one compacts
+                compact_vector_db(username, blocking=False)
+            except Exception as e:
+                logger.error(f"Error compacting vector database for {username}: {str(e)}")
@@ -20,12 +20,20 @@ const ChatFinal2 = () => {
     const fetchMessages = async () => {
       const token = localStorage.getItem('token');
       try {
-        const res = await apiClient.get(`/rag/getMessages?conId=${id}`, {
-          headers: { Authorization: `Bearer ${token}` },
-        });
+        // Messages come in pages; follow the cursor to the end of the chat
+        const rows = [];
+        let cursor = null;
+        do {
+          const res = await apiClient.get('/rag/getMessages', {
+            params: { conId: id, cursor },
+            headers: { Authorization: `Bearer ${token}` },
+          });
+          rows.push(...res.data.data);
+          cursor = res.data.next_cursor;
+        } while (cursor);
 
         // ✅ Map API response to internal format { text, sender }
-        const loadedMessages = res.data.data.map((msg) => ({
+        const loadedMessages = rows.map((msg) => ({
           text: msg.content,
           sender: msg.sender === 'ai' ? 'bot' : 'user',
         }));
@@ -41,6 +49,18 @@ const ChatFinal2 = () => {
   }
 }, [conversationId]);
 
+  // Uploads are parsed and indexed in the background; the document can be
+  // queried once its ingestion job is done
+  const waitForIngestion = async (jobId, token) => {
+    while (true) {
+      const res = await apiClient.get(`/rag/upload/${jobId}`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      if (res.data.status === 'done' || res.data.status === 'failed') return res.data;
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleFileChange = (e) => {
     const file = e.target.files[0];
     if (file) setSelectedFile(file);
@@ -51,6 +71,7 @@ const ChatFinal2 = () => {
 
     const token = localStorage.getItem('token');
     setIsUploading(true);
+    let conversationForQuery = conversationIdState;
 
     if (selectedFile) {
       const userMessage = { text: selectedFile.name, sender: 'user' };
@@ -76,12 +97,25 @@ const ChatFinal2 = () => {
         // Set conversation ID if returned from API
         if (res.data?.conversation_id) {
           setConversationId(res.data.conversation_id);
+          conversationForQuery = res.data.conversation_id;
         }
+
+        // Keep input disabled until the document can be queried
+        const job = await waitForIngestion(res.data.job_id, token);
+        if (job.status === 'failed') {
+          throw new Error(job.error || 'Processing the document failed.');
+        }
+        setMessages((prev) => [
+          ...prev,
+          { text: `${selectedFile.name} is ready. Ask me anything about it.`, sender: 'bot' },
+        ]);
       } catch (err) {
         setMessages((prev) => [
           ...prev,
           { text: 'Upload failed: ' + err.message, sender: 'bot' },
         ]);
+        setIsUploading(false);
+        return;
       } finally {
         setSelectedFile(null);
       }
@@ -96,7 +130,7 @@ const ChatFinal2 = () => {
           '/rag/query',
           {
             question: input,
-            conversation_id: conversationIdState,
+            conversation_id: conversationForQuery,
           },
           {
             headers: { Authorization: `Bearer ${token}` },
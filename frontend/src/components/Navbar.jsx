@@ -12,13 +12,23 @@ const Navbar = () => {
     fetchChats();
   }, []);
 
-  const fetchChats = () => {
-    apiClient
-      .get('/rag/getConversations', {
-        headers: { Authorization: `Bearer ${localStorage.getItem('token')}` },
-      })
-      .then((response) => setChatTitles(response.data.data))
-      .catch(console.error);
+  const fetchChats = async () => {
+    try {
+      // Conversations come in pages; follow the cursor to the last one
+      const chats = [];
+      let cursor = null;
+      do {
+        const response = await apiClient.get('/rag/getConversations', {
+          params: { cursor },
+          headers: { Authorization: `Bearer ${localStorage.getItem('token')}` },
+        });
+        chats.push(...response.data.data);
+        cursor = response.data.next_cursor;
+      } while (cursor);
+      setChatTitles(chats);
+    } catch (err) {
+      console.error(err);
+    }
   };
 
   const handleNewClick = () => {